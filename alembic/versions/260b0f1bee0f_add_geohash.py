@@ -0,0 +1,115 @@
+"""Add geohash
+
+Revision ID: 260b0f1bee0f
+Revises: 4b30ca264df3
+Create Date: 2026-10-18 16:42:18.317206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import math
+
+
+# revision identifiers, used by Alembic.
+revision = '260b0f1bee0f'
+down_revision = '4b30ca264df3'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['measurements', 'rollups']
+
+# Frozen copy of the encoder at the time, later changes to the app must not
+# change what this migration writes
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+
+
+def geohash(latitude, longitude, length=GEOHASH_PRECISION):
+    longitude_bits = (length * 5 + 1) // 2
+    latitude_bits = length * 5 // 2
+
+    column = math.floor((longitude + 180.0) / 360.0 * 2**longitude_bits)
+    row = math.floor((latitude + 90.0) / 180.0 * 2**latitude_bits)
+    column = min(max(column, 0), 2**longitude_bits - 1)
+    row = min(max(row, 0), 2**latitude_bits - 1)
+
+    value = 0
+    for bit in range(length * 5):
+        if bit % 2 == 0:
+            longitude_bits -= 1
+            value = value << 1 | (column >> longitude_bits) & 1
+        else:
+            latitude_bits -= 1
+            value = value << 1 | (row >> latitude_bits) & 1
+
+    return ''.join(
+        GEOHASH_ALPHABET[(value >> (5 * i)) & 31] for i in reversed(range(length))
+    )
+
+
+def backfill(table):
+    # Sensors barely move, so there are few positions compared to rows
+    bind = op.get_bind()
+    positions = bind.execute(
+        sa.text(
+            f'SELECT DISTINCT latitude, longitude FROM {table} '
+            'WHERE latitude IS NOT NULL AND longitude IS NOT NULL'
+        )
+    ).fetchall()
+
+    update = sa.text(
+        f'UPDATE {table} SET geohash = :geohash '
+        'WHERE latitude = :latitude AND longitude = :longitude'
+    )
+    parameters = [
+        {
+            'geohash': geohash(latitude, longitude),
+            'latitude': latitude,
+            'longitude': longitude,
+        }
+        for latitude, longitude in positions
+    ]
+    if parameters:
+        bind.execute(update, parameters)
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(
+            table,
+            sa.Column('geohash', sa.String(GEOHASH_PRECISION), nullable=True),
+        )
+        backfill(table)
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_measurements_geohash_recorded',
+            'measurements',
+            ['geohash', 'recorded'],
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            'ix_rollups_resolution_geohash_bucket',
+            'rollups',
+            ['resolution', 'geohash', 'bucket'],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_rollups_resolution_geohash_bucket',
+            table_name='rollups',
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            'ix_measurements_geohash_recorded',
+            table_name='measurements',
+            postgresql_concurrently=True,
+        )
+
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column('geohash')
@@ -0,0 +1,99 @@
+"""Add rollups
+
+Revision ID: 4b30ca264df3
+Revises: 6a1df0f74564
+Create Date: 2026-10-18 13:26:09.904512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b30ca264df3'
+down_revision = '6a1df0f74564'
+branch_labels = None
+depends_on = None
+
+
+STATS = ['pm1dot0', 'pm2dot5', 'pm10', 'humidity', 'temperature', 'pressure', 'co2']
+IDENTITY = 'sensor, source, description, latitude, longitude, provider_id'
+RESOLUTIONS = [60, 3600, 86400]
+
+
+def bucket(column, seconds):
+    if op.get_bind().dialect.name == 'postgresql':
+        return f'to_timestamp(floor(extract(epoch from {column}) / {seconds}) * {seconds})'
+
+    return (
+        "strftime('%Y-%m-%d %H:%M:%S.000000', "
+        f"(CAST(strftime('%s', {column}) AS INTEGER) / {seconds}) * {seconds}, "
+        "'unixepoch')"
+    )
+
+
+def backfill():
+    names = ', '.join(
+        f'{s}_sum, {s}_count, {s}_minimum, {s}_maximum' for s in STATS
+    )
+    raw = ', '.join(f'sum({s}), count({s}), min({s}), max({s})' for s in STATS)
+    merged = ', '.join(
+        f'sum({s}_sum), sum({s}_count), min({s}_minimum), max({s}_maximum)'
+        for s in STATS
+    )
+
+    previous = None
+    for resolution in RESOLUTIONS:
+        if previous is None:
+            source = f"{bucket('recorded', resolution)}, {resolution}, {IDENTITY}, {raw} FROM measurements"
+        else:
+            source = f"{bucket('bucket', resolution)}, {resolution}, {IDENTITY}, {merged} FROM rollups WHERE resolution = {previous}"
+
+        op.execute(
+            f'INSERT INTO rollups (bucket, resolution, {IDENTITY}, {names}) '
+            f'SELECT {source} GROUP BY 1, {IDENTITY}'
+        )
+        previous = resolution
+
+
+def upgrade():
+    columns = []
+    for stat in STATS:
+        columns.extend(
+            [
+                sa.Column(f'{stat}_sum', sa.Float(), nullable=True),
+                sa.Column(f'{stat}_count', sa.Integer(), nullable=True),
+                sa.Column(f'{stat}_minimum', sa.Float(), nullable=True),
+                sa.Column(f'{stat}_maximum', sa.Float(), nullable=True),
+            ]
+        )
+
+    op.create_table(
+        'rollups',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('resolution', sa.Integer(), nullable=False),
+        sa.Column('bucket', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('sensor', sa.String(), nullable=True),
+        sa.Column('source', sa.String(), nullable=True),
+        sa.Column('description', sa.String(), nullable=True),
+        sa.Column('longitude', sa.Float(), nullable=True),
+        sa.Column('latitude', sa.Float(), nullable=True),
+        sa.Column('provider_id', sa.Integer(), nullable=True),
+        *columns,
+        sa.ForeignKeyConstraint(['provider_id'], ['providers.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_rollups_resolution_bucket', 'rollups', ['resolution', 'bucket'])
+    op.create_index(
+        'ix_rollups_resolution_source_bucket',
+        'rollups',
+        ['resolution', 'source', 'bucket'],
+    )
+
+    backfill()
+
+
+def downgrade():
+    op.drop_index('ix_rollups_resolution_source_bucket', table_name='rollups')
+    op.drop_index('ix_rollups_resolution_bucket', table_name='rollups')
+    op.drop_table('rollups')
@@ -0,0 +1,47 @@
+"""Index measurements by recorded and id
+
+Revision ID: 6a1df0f74564
+Revises: e075e49b4963
+Create Date: 2026-10-18 11:03:47.582113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a1df0f74564'
+down_revision = 'e075e49b4963'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Pages are sorted by (recorded, id), this index serves recorded ranges too
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_measurements_recorded_id',
+            'measurements',
+            ['recorded', 'id'],
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            'ix_measurements_recorded',
+            table_name='measurements',
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_measurements_recorded',
+            'measurements',
+            ['recorded'],
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            'ix_measurements_recorded_id',
+            table_name='measurements',
+            postgresql_concurrently=True,
+        )
@@ -0,0 +1,140 @@
+"""Add devices
+
+Revision ID: 84a7cac653d1
+Revises: 260b0f1bee0f
+Create Date: 2026-10-18 19:05:41.628390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '84a7cac653d1'
+down_revision = '260b0f1bee0f'
+branch_labels = None
+depends_on = None
+
+
+IDENTITY = ['sensor', 'source', 'description', 'longitude', 'latitude']
+COLUMNS = IDENTITY + ['geohash']
+TABLES = ['measurements', 'rollups']
+INDEXES = {
+    'measurements': [
+        ('ix_measurements_source_recorded', ['source', 'recorded']),
+        ('ix_measurements_latitude_longitude', ['latitude', 'longitude']),
+        ('ix_measurements_geohash_recorded', ['geohash', 'recorded']),
+    ],
+    'rollups': [
+        ('ix_rollups_resolution_source_bucket', ['resolution', 'source', 'bucket']),
+        ('ix_rollups_resolution_geohash_bucket', ['resolution', 'geohash', 'bucket']),
+    ],
+}
+DEVICE_INDEXES = {
+    'measurements': ('ix_measurements_device_id_recorded', ['device_id', 'recorded']),
+    'rollups': (
+        'ix_rollups_resolution_device_id_bucket',
+        ['resolution', 'device_id', 'bucket'],
+    ),
+}
+
+
+# Missing and empty descriptions are the same device
+DESCRIPTION = "COALESCE(description, '')"
+
+
+def same(table, column):
+    # Plain equalities, so the database can join instead of looking up each row
+    if column == 'description':
+        return f"COALESCE(devices.{column}, '') = COALESCE({table}.{column}, '')"
+    return f'devices.{column} = {table}.{column}'
+
+
+def upgrade():
+    op.create_table(
+        'devices',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sensor', sa.String(), nullable=True),
+        sa.Column('source', sa.String(), nullable=True),
+        sa.Column('description', sa.String(), nullable=True),
+        sa.Column('longitude', sa.Float(), nullable=True),
+        sa.Column('latitude', sa.Float(), nullable=True),
+        sa.Column('geohash', sa.String(9), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_devices_source', 'devices', ['source'])
+    op.create_index('ix_devices_geohash', 'devices', ['geohash'])
+
+    grouped = ', '.join(DESCRIPTION if c == 'description' else c for c in IDENTITY)
+    selected = ', '.join(f'max({c})' if c == 'description' else c for c in IDENTITY)
+    union = ' UNION '.join(f'SELECT {", ".join(COLUMNS)} FROM {t}' for t in TABLES)
+    op.execute(
+        f'INSERT INTO devices ({", ".join(COLUMNS)}) '
+        f'SELECT {selected}, max(geohash) FROM ({union}) AS identities '
+        f'GROUP BY {grouped}'
+    )
+    op.create_index(
+        'ux_devices_identity',
+        'devices',
+        ['sensor', 'source', sa.text(DESCRIPTION), 'latitude', 'longitude'],
+        unique=True,
+    )
+
+    for table in TABLES:
+        op.add_column(table, sa.Column('device_id', sa.Integer(), nullable=True))
+        conditions = ' AND '.join(same(table, c) for c in IDENTITY)
+        op.execute(
+            f'UPDATE {table} SET device_id = devices.id FROM devices '
+            f'WHERE {conditions}'
+        )
+
+        for name, _ in INDEXES[table]:
+            op.drop_index(name, table_name=table)
+
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column('device_id', existing_type=sa.Integer(), nullable=False)
+            batch.create_foreign_key(
+                f'fk_{table}_device_id_devices', 'devices', ['device_id'], ['id']
+            )
+            for column in COLUMNS:
+                batch.drop_column(column)
+
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            name, columns = DEVICE_INDEXES[table]
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            name, _ = DEVICE_INDEXES[table]
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch:
+            batch.add_column(sa.Column('sensor', sa.String(), nullable=True))
+            batch.add_column(sa.Column('source', sa.String(), nullable=True))
+            batch.add_column(sa.Column('description', sa.String(), nullable=True))
+            batch.add_column(sa.Column('longitude', sa.Float(), nullable=True))
+            batch.add_column(sa.Column('latitude', sa.Float(), nullable=True))
+            batch.add_column(sa.Column('geohash', sa.String(9), nullable=True))
+
+        for column in COLUMNS:
+            op.execute(
+                f'UPDATE {table} SET {column} = '
+                f'(SELECT devices.{column} FROM devices '
+                f'WHERE devices.id = {table}.device_id)'
+            )
+
+        with op.batch_alter_table(table) as batch:
+            batch.drop_constraint(f'fk_{table}_device_id_devices', type_='foreignkey')
+            batch.drop_column('device_id')
+
+        for name, columns in INDEXES[table]:
+            op.create_index(name, table, columns)
+
+    op.drop_index('ux_devices_identity', table_name='devices')
+    op.drop_index('ix_devices_geohash', table_name='devices')
+    op.drop_index('ix_devices_source', table_name='devices')
+    op.drop_table('devices')
@@ -0,0 +1,62 @@
+"""Track when devices last had measurements stored
+
+Revision ID: b7e2d4c91a3f
+Revises: 84a7cac653d1
+Create Date: 2026-10-18 21:14:52.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d4c91a3f'
+down_revision = '84a7cac653d1'
+branch_labels = None
+depends_on = None
+
+
+# Devices updated at once by the backfill
+BATCH_SIZE = 1000
+
+
+def backfill():
+    # The latest measurement stands for when it was stored, or the latest hourly
+    # rollup once they were compacted
+    bind = op.get_bind()
+    last = bind.execute(sa.text('SELECT max(id) FROM devices')).scalar() or 0
+
+    update = sa.text(
+        'UPDATE devices SET ingested = COALESCE('
+        '(SELECT max(recorded) FROM measurements '
+        'WHERE measurements.device_id = devices.id), '
+        '(SELECT max(bucket) FROM rollups '
+        'WHERE rollups.resolution = 3600 AND rollups.device_id = devices.id)) '
+        'WHERE id > :start AND id <= :end'
+    )
+    for start in range(0, last, BATCH_SIZE):
+        bind.execute(update, {'start': start, 'end': start + BATCH_SIZE})
+
+
+def upgrade():
+    op.add_column(
+        'devices',
+        sa.Column('ingested', sa.DateTime(timezone=True), nullable=True),
+    )
+    backfill()
+    op.create_index('ix_devices_ingested', 'devices', ['ingested'])
+
+
+def downgrade():
+    op.drop_index('ix_devices_ingested', table_name='devices')
+
+    # SQLite copies the table to drop the column, which loses expression indexes
+    op.drop_index('ux_devices_identity', table_name='devices')
+    with op.batch_alter_table('devices') as batch:
+        batch.drop_column('ingested')
+    op.create_index(
+        'ux_devices_identity',
+        'devices',
+        ['sensor', 'source', sa.text("COALESCE(description, '')"), 'latitude', 'longitude'],
+        unique=True,
+    )
@@ -0,0 +1,46 @@
+"""Index measurements
+
+Revision ID: e075e49b4963
+Revises: 13f6a43615e3
+Create Date: 2026-10-18 09:12:31.417920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e075e49b4963'
+down_revision = '13f6a43615e3'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = {
+    'ix_measurements_recorded': ['recorded'],
+    'ix_measurements_source_recorded': ['source', 'recorded'],
+    'ix_measurements_latitude_longitude': ['latitude', 'longitude'],
+}
+
+
+def upgrade():
+    # CONCURRENTLY can't run inside a transaction, so step out of it on PostgreSQL
+    # to avoid locking the table against writes while the indexes are built.
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES.items():
+            op.create_index(
+                name,
+                'measurements',
+                columns,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name in INDEXES.keys():
+            op.drop_index(
+                name,
+                table_name='measurements',
+                postgresql_concurrently=True,
+            )
@@ -22,6 +22,7 @@ from fastapi import HTTPException, Security, status
 from fastapi.security.api_key import APIKeyHeader, APIKey
 
 from .db import db
+from .cache import MISSING
 from . import models
 
 
@@ -36,7 +37,14 @@ async def validate_api_key(raw_api_key: APIKey = Security(query)):
         raise InvalidAPIKey
 
     key = hashlib.sha256(raw_api_key.encode("utf-8")).hexdigest()
-    provider = await models.Provider.get_provider_for_key(db, key)
+    provider = models.keys_cache.get(key)
+    if provider is MISSING:
+        generation = models.keys_cache.generation
+        provider = await models.Provider.get_provider_for_key(db, key)
+        # Don't keep providers that could have been revoked meanwhile
+        if models.keys_cache.generation == generation:
+            models.keys_cache.set(key, provider)
+
     if not provider:
         raise InvalidAPIKey
 
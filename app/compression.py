@@ -0,0 +1,166 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import zlib
+import brotli
+import zstandard
+
+from starlette.datastructures import Headers, MutableHeaders
+from typing import Any, Callable, Dict, List, Optional
+
+
+class Gzip:
+    def __init__(self, level: int) -> None:
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, more: bool) -> bytes:
+        mode = zlib.Z_SYNC_FLUSH if more else zlib.Z_FINISH
+        return self._compressor.compress(data) + self._compressor.flush(mode)
+
+
+class Zstd:
+    def __init__(self, level: int) -> None:
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes, more: bool) -> bytes:
+        mode = (
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            if more
+            else zstandard.COMPRESSOBJ_FLUSH_FINISH
+        )
+        return self._compressor.compress(data) + self._compressor.flush(mode)
+
+
+class Brotli:
+    def __init__(self, level: int) -> None:
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes, more: bool) -> bytes:
+        flush = self._compressor.flush if more else self._compressor.finish
+        return self._compressor.process(data) + flush()
+
+
+ENCODERS: Dict[str, Callable[[int], Any]] = {
+    "zstd": Zstd,
+    "br": Brotli,
+    "gzip": Gzip,
+}
+
+
+def negotiate(accept: str, encodings: List[str]) -> Optional[str]:
+    # The highest weighted encoding, or the first one on a tie
+    weights = {}
+    for part in accept.split(","):
+        name, *params = [p.strip() for p in part.split(";")]
+        weight = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if name:
+            weights[name.lower()] = weight
+
+    chosen, best = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best:
+            chosen, best = encoding, weight
+
+    return chosen
+
+
+class Compress:
+    # Compresses responses of at least minimum bytes, or streamed ones,
+    # with the encoding the client prefers
+    def __init__(
+        self,
+        app: Callable,
+        encodings: List[str],
+        minimum: int,
+        levels: Dict[str, int],
+    ) -> None:
+        self.app = app
+        self.encodings = [e.strip() for e in encodings if e.strip() in ENCODERS]
+        self.minimum = minimum
+        self.levels = levels
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http" or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+
+        accept = Headers(scope=scope).get("accept-encoding", "")
+        encoding = negotiate(accept, self.encodings)
+
+        start: Dict = {}
+        encoder = None
+        passthrough = False
+
+        async def compress(message: Dict) -> None:
+            nonlocal start, encoder, passthrough
+
+            if message["type"] == "http.response.start":
+                # Held until the first body tells if it's worth compressing
+                start = message
+                headers = MutableHeaders(raw=start.setdefault("headers", []))
+                passthrough = "content-encoding" in headers
+                if not passthrough:
+                    headers.add_vary_header("Accept-Encoding")
+                return
+
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            if passthrough:
+                if start:
+                    await send(start)
+                    start = {}
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+
+            if encoder is None:
+                if encoding is None or (not more and len(body) < self.minimum):
+                    passthrough = True
+                    await send(start)
+                    start = {}
+                    await send(message)
+                    return
+
+                encoder = ENCODERS[encoding](self.levels[encoding])
+                headers = MutableHeaders(raw=start["headers"])
+                headers["Content-Encoding"] = encoding
+                # Different bytes than the identity response it was made for
+                if headers.get("etag", "").startswith('"'):
+                    headers["ETag"] = f"W/{headers['etag']}"
+                del headers["Content-Length"]
+
+                body = encoder.compress(body, more)
+                if not more:
+                    headers["Content-Length"] = str(len(body))
+                await send(start)
+                start = {}
+            else:
+                body = encoder.compress(body, more)
+
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, compress)
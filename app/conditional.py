@@ -0,0 +1,113 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import dataclasses
+
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import HTTPException, Request, Response, status
+from typing import Any, Dict, Optional
+
+from . import schemas
+from .functions import as_utc, floor
+
+# Seconds the default window is rounded down to, so polling it gets the same
+# validators until it moves on to the next step
+DEFAULT_WINDOW_STEP = 60
+
+
+def window(request: Request, query: Any) -> Any:
+    # The query the validators stand for, in UTC
+    start = as_utc(query.start) if query.start else None
+    end = as_utc(query.end) if query.end else None
+    if start is not None and "start" not in request.query_params:
+        start = floor(start, DEFAULT_WINDOW_STEP)
+
+    return dataclasses.replace(query, start=start, end=end)
+
+
+def changed(
+    request: Request, query: Any, ingested: Optional[datetime]
+) -> Optional[datetime]:
+    # Besides new measurements, the default window moves on with time, and
+    # NowCast without an end moves on to the next hour
+    times = [ingested] if ingested is not None else []
+    if "start" not in request.query_params:
+        times.append(query.start + schemas.DEFAULT_WINDOW)
+    if getattr(query, "method", None) == schemas.Method.NOWCAST and not query.end:
+        times.append(floor(datetime.now(timezone.utc), 3600))
+
+    return max(times, default=None)
+
+
+def validators(
+    request: Request, query: Any, ingested: Optional[datetime]
+) -> Dict[str, str]:
+    query = window(request, query)
+    modified = changed(request, query, ingested)
+
+    key = (
+        request.url.path,
+        request.headers.get("accept"),
+        dataclasses.astuple(query),
+        ingested,
+        modified,
+    )
+    digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:32]
+
+    # Clients and caches check with us every time, instead of guessing
+    headers = {"ETag": f'"{digest}"', "Cache-Control": "no-cache"}
+    if modified is not None:
+        modified = min(modified, datetime.now(timezone.utc))
+        headers["Last-Modified"] = format_datetime(modified, usegmt=True)
+
+    return headers
+
+
+def unchanged(request: Request, headers: Dict[str, str]) -> bool:
+    # If-None-Match wins when both are sent, tags compared weakly since
+    # compressed responses get weak ones
+    match = request.headers.get("if-none-match")
+    if match is not None:
+        tags = [t.strip() for t in match.split(",")]
+        tags = [t[2:] if t.startswith("W/") else t for t in tags]
+        return "*" in tags or headers["ETag"] in tags
+
+    since = request.headers.get("if-modified-since")
+    if since is None or "Last-Modified" not in headers:
+        return False
+
+    try:
+        since = as_utc(parsedate_to_datetime(since))
+    except (TypeError, ValueError):
+        return False
+
+    return parsedate_to_datetime(headers["Last-Modified"]) <= since
+
+
+def check(request: Request, query: Any, ingested: Optional[datetime]) -> Dict:
+    # Headers for the response to the query, unless the client has it already
+    headers = validators(request, query, ingested)
+    if unchanged(request, headers):
+        raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return headers
+
+
+def tag(content: Any, response: Response, headers: Dict[str, str]) -> Any:
+    # Returned responses don't get the headers set on the injected one
+    target = content if isinstance(content, Response) else response
+    target.headers.update(headers)
+    return content
@@ -0,0 +1,244 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import csv
+import json
+import zlib
+import cbor2
+import msgpack
+import zstandard
+
+from fastapi import HTTPException, Request, status
+from fastapi.exceptions import RequestValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import MissingError
+from typing import Any, Callable, Dict, List
+
+from .ingest import FIELDS
+
+
+MAX_BODY_SIZE = int(os.environ.get("LINKA_INGEST_MAX_BODY_SIZE", 64 * 1024 * 1024))
+
+InvalidBody = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="There was an error parsing the body",
+)
+BodyTooLarge = HTTPException(
+    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    detail="Body is too large",
+)
+UnsupportedBody = HTTPException(
+    status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+    detail="Unsupported content type or encoding",
+)
+
+# Empty CSV cells are left out, and numbers parsed, so rows look like JSON ones
+NUMBERS = {n for n, f in FIELDS.items() if issubclass(f.type_, float)}
+
+
+# Decompressed at most this much at once, so bodies are checked as they grow
+CHUNK_SIZE = 64 * 1024
+
+
+class Body:
+    # Rejected as soon as it passes the limit, not once it's all decompressed
+    def __init__(self, limit: int) -> None:
+        self.data = bytearray()
+        self.limit = limit
+
+    def write(self, data: bytes) -> int:
+        self.data += data
+        if len(self.data) > self.limit:
+            raise BodyTooLarge
+        return len(data)
+
+
+class Identity:
+    def __init__(self, body: Body) -> None:
+        self._body = body
+
+    def decompress(self, chunk: bytes) -> None:
+        self._body.write(chunk)
+
+    def flush(self) -> None:
+        pass
+
+
+class Gzip:
+    def __init__(self, body: Body) -> None:
+        self._body = body
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, chunk: bytes) -> None:
+        while chunk:
+            self._body.write(self._decompressor.decompress(chunk, CHUNK_SIZE))
+            chunk = self._decompressor.unconsumed_tail
+
+    def flush(self) -> None:
+        self._body.write(self._decompressor.flush())
+
+
+class Zstd:
+    def __init__(self, body: Body) -> None:
+        # Writes to the body as each block is decompressed
+        self._writer = zstandard.ZstdDecompressor().stream_writer(
+            body, write_size=CHUNK_SIZE
+        )
+
+    def decompress(self, chunk: bytes) -> None:
+        self._writer.write(chunk)
+
+    def flush(self) -> None:
+        pass
+
+
+ENCODINGS: Dict[str, Callable[[Body], Any]] = {
+    "identity": Identity,
+    "gzip": Gzip,
+    "zstd": Zstd,
+}
+
+
+async def read(request: Request) -> bytes:
+    # Decompressed as it arrives, so only the result needs to fit in the limit
+    encoding = request.headers.get("content-encoding", "identity").strip().lower()
+    if encoding not in ENCODINGS:
+        raise UnsupportedBody
+
+    body = Body(MAX_BODY_SIZE)
+    decompressor = ENCODINGS[encoding](body)
+
+    try:
+        async for chunk in request.stream():
+            # The stream ends with an empty chunk
+            if chunk:
+                decompressor.decompress(chunk)
+        decompressor.flush()
+    except (zlib.error, zstandard.ZstdError):
+        raise InvalidBody
+
+    return bytes(body.data)
+
+
+def header_rows(header: List[Any], rows: List[Any]) -> List[Any]:
+    if not all(isinstance(h, str) for h in header):
+        raise InvalidBody
+
+    # Rows with a different number of values are left for validation to reject
+    return [
+        dict(zip(header, r)) if isinstance(r, list) and len(r) == len(header) else r
+        for r in rows
+    ]
+
+
+def column_rows(columns: Dict[Any, Any]) -> List[Dict[Any, Any]]:
+    if not all(isinstance(k, str) for k in columns):
+        raise InvalidBody
+    if not all(isinstance(c, list) for c in columns.values()):
+        raise InvalidBody
+    if len({len(c) for c in columns.values()}) > 1:
+        raise InvalidBody
+
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def unpack(data: Any) -> Any:
+    # One object per row, or a header row followed by the values of each, or
+    # one array per field
+    if isinstance(data, dict):
+        return column_rows(data)
+    if isinstance(data, list) and data and isinstance(data[0], list):
+        return header_rows(data[0], data[1:])
+    return data
+
+
+def number(value: str) -> Any:
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_json(body: bytes) -> Any:
+    try:
+        return json.loads(body)
+    except json.JSONDecodeError as error:
+        raise RequestValidationError(
+            [ErrorWrapper(error, ("body", error.pos))], body=error.doc
+        )
+    except UnicodeDecodeError:
+        raise InvalidBody
+
+
+def parse_msgpack(body: bytes) -> Any:
+    try:
+        return unpack(msgpack.unpackb(body, raw=False, strict_map_key=False))
+    except (ValueError, TypeError, msgpack.UnpackException):
+        raise InvalidBody
+
+
+def parse_cbor(body: bytes) -> Any:
+    try:
+        return unpack(cbor2.loads(body))
+    except (ValueError, TypeError, cbor2.CBORDecodeError):
+        raise InvalidBody
+
+
+def parse_csv(body: bytes) -> Any:
+    try:
+        lines = csv.reader(io.StringIO(body.decode("utf-8-sig"), newline=""))
+        header = next(lines, [])
+        rows = [r for r in lines if r]
+    except (UnicodeDecodeError, csv.Error):
+        raise InvalidBody
+
+    converters = [number if h in NUMBERS else str for h in header]
+    return [
+        {h: f(v) for h, f, v in zip(header, converters, r) if v != ""}
+        if len(r) == len(header)
+        else r
+        for r in rows
+    ]
+
+
+PARSERS: Dict[str, Callable[[bytes], Any]] = {
+    "application/json": parse_json,
+    "application/msgpack": parse_msgpack,
+    "application/x-msgpack": parse_msgpack,
+    "application/cbor": parse_cbor,
+    "text/csv": parse_csv,
+}
+
+
+def parser(content_type: str) -> Callable[[bytes], Any]:
+    media_type = content_type.split(";")[0].strip().lower()
+    if not media_type or media_type.endswith("+json"):
+        return parse_json
+    if media_type not in PARSERS:
+        raise UnsupportedBody
+    return PARSERS[media_type]
+
+
+async def decode(request: Request) -> Any:
+    parse = parser(request.headers.get("content-type", ""))
+    body = await read(request)
+
+    # Same as FastAPI does for a missing JSON body
+    if not body:
+        raise RequestValidationError([ErrorWrapper(MissingError(), loc=("body",))])
+
+    return parse(body)
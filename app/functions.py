@@ -0,0 +1,185 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import functools
+import sqlalchemy
+import numpy as np
+
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from typing import List, Optional, Tuple
+
+
+class bucket(FunctionElement):
+    type = sqlalchemy.DateTime(timezone=True)
+    name = "bucket"
+    inherit_cache = True
+
+    def __init__(self, column, seconds):
+        # Rendered as a literal, so the same expression can be used in GROUP BY
+        self.seconds = int(seconds)
+        super().__init__(column)
+
+
+@compiles(bucket, "postgresql")
+def compile_bucket_postgresql(element, compiler, **kw):
+    column = compiler.process(list(element.clauses)[0], **kw)
+    seconds = element.seconds
+    return f"to_timestamp(floor(extract(epoch from {column}) / {seconds}) * {seconds})"
+
+
+@compiles(bucket, "sqlite")
+def compile_bucket_sqlite(element, compiler, **kw):
+    # Same format SQLAlchemy uses to store DateTime values in SQLite
+    column = compiler.process(list(element.clauses)[0], **kw)
+    seconds = element.seconds
+    return (
+        "strftime('%Y-%m-%d %H:%M:%S.000000', "
+        f"(CAST(strftime('%s', {column}) AS INTEGER) / {seconds}) * {seconds}, "
+        "'unixepoch')"
+    )
+
+
+def as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def as_float(value: Optional[float]) -> Optional[float]:
+    # Same as pydantic does for float fields, so integers come out as 1.0
+    return None if value is None else float(value)
+
+
+def floor(value: datetime, seconds: int) -> datetime:
+    epoch = as_utc(value).timestamp()
+    return datetime.fromtimestamp(epoch - epoch % seconds, timezone.utc)
+
+
+def ceil(value: datetime, seconds: int) -> datetime:
+    floored = floor(value, seconds)
+    if floored == as_utc(value):
+        return floored
+    return floored + timedelta(seconds=seconds)
+
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# About 5 meters, more than enough for pruning
+GEOHASH_PRECISION = 9
+# More cells than this fall back to a shorter prefix
+GEOHASH_MAX_CELLS = 16
+EARTH_RADIUS = 6371.0088
+
+
+def geohash_indexes(
+    latitude: float, longitude: float, length: int
+) -> Tuple[int, int, int, int]:
+    # Cell column and row in a grid of 2 ** bits, the longitude takes the odd bit
+    longitude_bits = (length * 5 + 1) // 2
+    latitude_bits = length * 5 // 2
+
+    column = math.floor((longitude + 180.0) / 360.0 * 2**longitude_bits)
+    row = math.floor((latitude + 90.0) / 180.0 * 2**latitude_bits)
+    column = min(max(column, 0), 2**longitude_bits - 1)
+    row = min(max(row, 0), 2**latitude_bits - 1)
+
+    return column, row, longitude_bits, latitude_bits
+
+
+def geohash_encode(column: int, row: int, length: int) -> str:
+    longitude_bits = (length * 5 + 1) // 2
+    latitude_bits = length * 5 // 2
+
+    value = 0
+    for bit in range(length * 5):
+        if bit % 2 == 0:
+            longitude_bits -= 1
+            value = value << 1 | (column >> longitude_bits) & 1
+        else:
+            latitude_bits -= 1
+            value = value << 1 | (row >> latitude_bits) & 1
+
+    return "".join(
+        GEOHASH_ALPHABET[(value >> (5 * i)) & 31] for i in reversed(range(length))
+    )
+
+
+def geohash(latitude: float, longitude: float, length: int = GEOHASH_PRECISION) -> str:
+    column, row, _, _ = geohash_indexes(latitude, longitude, length)
+    return geohash_encode(column, row, length)
+
+
+@functools.lru_cache(maxsize=1024)
+def geohash_cells(
+    north: float, east: float, south: float, west: float
+) -> Optional[Tuple[str, ...]]:
+    # Longest prefixes that cover the box in a few cells, None if it can't be done
+    if west > east:
+        return None
+
+    for length in reversed(range(1, GEOHASH_PRECISION + 1)):
+        west_column, south_row, _, _ = geohash_indexes(south, west, length)
+        east_column, north_row, _, _ = geohash_indexes(north, east, length)
+
+        columns = range(west_column, east_column + 1)
+        rows = range(south_row, north_row + 1)
+        if len(columns) * len(rows) > GEOHASH_MAX_CELLS:
+            continue
+
+        return tuple(geohash_encode(c, r, length) for c in columns for r in rows)
+
+    return None
+
+
+def haversine(
+    latitude: float, longitude: float, latitudes: List[float], longitudes: List[float]
+) -> np.ndarray:
+    # Kilometers from the target to every point
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+
+    a = (
+        np.sin((latitudes - latitude) / 2) ** 2
+        + np.cos(latitude)
+        * np.cos(latitudes)
+        * np.sin((longitudes - longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+@functools.lru_cache(maxsize=1024)
+def bounds(
+    latitude: float, longitude: float, kilometers: float
+) -> Tuple[float, float, float, float]:
+    # Box around the circle on the same sphere as haversine. Paths heading east
+    # or west curve towards the equator, so the widest longitudes are at the
+    # latitude where a meridian touches the circle instead.
+    angle = math.degrees(kilometers / EARTH_RADIUS)
+    north = latitude + angle
+    south = latitude - angle
+
+    # The circle includes a pole, so every longitude
+    if north >= 90.0 or south <= -90.0:
+        return min(north, 90.0), 180.0, max(south, -90.0), -180.0
+
+    delta = math.degrees(
+        math.asin(
+            math.sin(kilometers / EARTH_RADIUS) / math.cos(math.radians(latitude))
+        )
+    )
+    return north, min(longitude + delta, 180.0), south, max(longitude - delta, -180.0)
@@ -0,0 +1,248 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import asyncio
+import logging
+import itertools
+import numpy as np
+
+from datetime import datetime, timezone
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import ListError, NoneIsNotAllowedError
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .schemas import Measurement
+from .functions import as_utc
+
+
+logger = logging.getLogger(__name__)
+
+# Field types and bounds come from the schema, so both paths agree
+FIELDS = Measurement.__fields__
+STRINGS = (str,)
+NUMBERS = (int, float, type(None))
+# The forms parsed the same by pydantic and fromisoformat, within the years
+# that survive the round trip through a float timestamp in must_be_utc
+TIMESTAMP = re.compile(
+    r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d{3}|\.\d{6})?(Z|[+-]\d{2}:\d{2})?",
+    re.ASCII,
+)
+YEARS = range(1970, 2100)
+
+
+def typed(values: List[Any], types: Tuple[type, ...]) -> np.ndarray:
+    # Columns are usually all of the expected types, so check that first
+    if set(map(type, values)).issubset(types):
+        return np.ones(len(values), bool)
+    return np.fromiter((type(v) in types for v in values), bool, len(values))
+
+
+def validate_strings(values: List[Any], required: bool) -> np.ndarray:
+    return typed(values, STRINGS if required else STRINGS + (type(None),))
+
+
+def validate_numbers(values: List[Any], field: Any) -> np.ndarray:
+    valid = typed(values, NUMBERS)
+    if not valid.all():
+        values[:] = [v if t else None for v, t in zip(values, valid.tolist())]
+
+    try:
+        array = np.array(values, dtype=np.float64)
+    except OverflowError:
+        return np.zeros(len(values), bool)
+
+    # None is NaN here, and so fails both bounds like NaN itself does
+    missing = np.isnan(array)
+    if missing.any():
+        missing &= np.fromiter((v is None for v in values), bool, len(values))
+
+    inside = np.ones(len(values), bool)
+    if field.field_info.ge is not None:
+        inside &= array >= field.field_info.ge
+    if field.field_info.le is not None:
+        inside &= array <= field.field_info.le
+
+    values[:] = array.tolist()
+    for index in np.flatnonzero(missing).tolist():
+        values[index] = None
+
+    return valid & np.where(missing, not field.required, inside)
+
+
+def normalize_timestamp(value: Any) -> Optional[datetime]:
+    if type(value) is str and TIMESTAMP.fullmatch(value):
+        if value[-1] == "Z":
+            value = value[:-1] + "+00:00"
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    elif type(value) is not datetime:
+        return None
+
+    if value.year not in YEARS:
+        return None
+
+    return as_utc(value)
+
+
+def validate_timestamps(values: List[Any], present: List[bool]) -> np.ndarray:
+    # Missing ones get the default, which pydantic doesn't validate either
+    values[:] = [
+        normalize_timestamp(v) if p else datetime.now(timezone.utc)
+        for v, p in zip(values, present)
+    ]
+
+    return np.fromiter((v is not None for v in values), bool, len(values))
+
+
+def validate_measurements(body: Any, provider: str) -> List[Dict[str, Any]]:
+    # Checks whole columns at once, only the rows that fail any check go
+    # through the pydantic model, which then reports them exactly as before
+    if not isinstance(body, list):
+        raise RequestValidationError(
+            [ErrorWrapper(ListError(), loc=("body",))], body=body
+        )
+
+    valid = typed(body, (dict,))
+    rows = body if valid.all() else [r if v else {} for r, v in zip(body, valid)]
+
+    columns = []
+    for name, field in FIELDS.items():
+        values = [r.get(name) for r in rows]
+
+        if field.type_ is str:
+            valid &= validate_strings(values, field.required)
+        elif issubclass(field.type_, float):
+            valid &= validate_numbers(values, field)
+        else:
+            valid &= validate_timestamps(values, [name in r for r in rows])
+
+        columns.append(values)
+
+    keys = list(FIELDS) + ["provider_id"]
+    results = [
+        dict(zip(keys, values)) for values in zip(*columns, itertools.repeat(provider))
+    ]
+
+    errors = []
+    for index in np.flatnonzero(~valid).tolist():
+        if body[index] is None:
+            errors.append(ErrorWrapper(NoneIsNotAllowedError(), loc=("body", index)))
+            continue
+        try:
+            results[index] = Measurement.validate(body[index]).to_orm(provider)
+        except ValidationError as error:
+            errors.append(ErrorWrapper(error, loc=("body", index)))
+
+    if errors:
+        raise RequestValidationError(errors, body=body)
+
+    return results
+
+
+class Buffer:
+    def __init__(
+        self,
+        store: Callable[[List[Any]], Awaitable[None]],
+        size: int,
+        batch: int,
+        interval: float,
+        retries: int = 3,
+        backoff: float = 0.5,
+    ) -> None:
+        self.store = store
+        self.size = size
+        self.batch = batch
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        # Measurements given up on, they were already accepted with a 202
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def put(self, rows: List[Any]) -> bool:
+        if self._queue.qsize() + len(rows) > self.size:
+            return False
+
+        for row in rows:
+            self._queue.put_nowait(row)
+
+        return True
+
+    async def start(self) -> None:
+        # Created here so the queue belongs to the running loop
+        self._queue = asyncio.Queue(maxsize=self.size)
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._closing = True
+        await self._task
+
+    async def _collect(self) -> List[Any]:
+        loop = asyncio.get_running_loop()
+        rows = []
+        deadline = loop.time() + self.interval
+
+        while len(rows) < self.batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+            # Everything queued meanwhile, without waiting on each row
+            while len(rows) < self.batch and not self._queue.empty():
+                rows.append(self._queue.get_nowait())
+
+        return rows
+
+    async def _store(self, rows: List[Any]) -> None:
+        # Stores are transactions, so a failed one can be tried again
+        for attempt in range(self.retries + 1):
+            try:
+                await self.store(rows)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    self.dropped += len(rows)
+                    logger.exception("Dropped %d buffered measurements", len(rows))
+                    return
+                logger.warning(
+                    "Failed to store %d buffered measurements, retrying",
+                    len(rows),
+                    exc_info=True,
+                )
+                await asyncio.sleep(self.backoff * 2**attempt)
+
+    async def _run(self) -> None:
+        while not self._closing or not self._queue.empty():
+            rows = await self._collect()
+            if not rows:
+                continue
+
+            await self._store(rows)
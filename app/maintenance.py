@@ -0,0 +1,69 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import asyncio
+import argparse
+
+from . import models
+from . import partitions
+from .db import db
+
+
+async def partition(args):
+    if not partitions.supported(db):
+        sys.exit("partitions are only supported on PostgreSQL")
+
+    created = await partitions.maintain(db, args.months, args.enable)
+    for name in created:
+        print(name)
+
+
+async def retention(args):
+    if models.Retention.horizon() is None:
+        sys.exit("LINKA_RETENTION_DAYS is not set")
+
+    deleted = await models.Retention.compact(db, args.batch_size)
+    print(f"{deleted} measurements compacted")
+
+
+async def run(args):
+    await db.connect()
+    try:
+        await args.command(args)
+    finally:
+        await db.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m app.maintenance")
+    commands = parser.add_subparsers(required=True)
+
+    parser_partitions = commands.add_parser("partitions")
+    parser_partitions.add_argument("--months", type=int, default=3)
+    parser_partitions.add_argument("--enable", action="store_true")
+    parser_partitions.set_defaults(command=partition)
+
+    parser_retention = commands.add_parser("retention")
+    parser_retention.add_argument(
+        "--batch-size", type=int, default=models.RETENTION_BATCH_SIZE
+    )
+    parser_retention.set_defaults(command=retention)
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import abc
+import time
+import bisect
+import inspect
+import functools
+
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+SECONDS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+SIZES = [1, 10, 100, 500, 1000, 5000, 10000, 50000]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def labeled(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+
+    pairs = ",".join(f'{k}="{escape(v)}"' for k, v in labels)
+    return f"{name}{{{pairs}}}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        pass
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{labeled(name, labels)} {number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, value in sorted(self._values.items()):
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: List[float] = SECONDS) -> None:
+        super().__init__(name, help)
+        self.buckets = sorted(buckets)
+        self._values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        # One count per bucket, plus +Inf and the sum
+        values = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, values in sorted(self._values.items()):
+            count = 0
+            for bound, observed in zip(self.buckets + [float("inf")], values):
+                count += observed
+                yield f"{self.name}_bucket", labels + (("le", number(bound)),), count
+            yield f"{self.name}_sum", labels, values[-1]
+            yield f"{self.name}_count", labels, count
+
+
+class Callback(Metric):
+    # Read from elsewhere on every scrape, None leaves it out
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        function: Callable[[], Dict[Labels, Optional[float]]],
+    ) -> None:
+        super().__init__(name, help)
+        self.type = type
+        self.function = function
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, value in sorted(self.function().items()):
+            if value is not None:
+                yield self.name, labels, value
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Any:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+
+registry = Registry()
+
+requests_seconds = registry.register(
+    Histogram("linka_request_duration_seconds", "Time spent answering requests")
+)
+queries_seconds = registry.register(
+    Histogram("linka_query_duration_seconds", "Time spent in database queries")
+)
+ingested = registry.register(
+    Counter("linka_ingested_measurements_total", "Measurements stored")
+)
+batches = registry.register(
+    Histogram("linka_ingest_batch_size", "Measurements stored at once", SIZES)
+)
+
+
+def timed(query: str) -> Callable:
+    # Times a query, async generators from the first to the last row
+    def decorator(function: Callable) -> Callable:
+        if inspect.isasyncgenfunction(function):
+
+            @functools.wraps(function)
+            async def generator(*args: Any, **kwargs: Any) -> Any:
+                with queries_seconds.time(query=query):
+                    async for item in function(*args, **kwargs):
+                        yield item
+
+            return generator
+
+        @functools.wraps(function)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with queries_seconds.time(query=query):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Instrument:
+    # Times whole responses, streamed ones included, by route
+    def __init__(self, app: Callable) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = ["500"]
+
+        async def started(message: Dict) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, started)
+        finally:
+            route = scope.get("route")
+            requests_seconds.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                path=getattr(route, "path", "unmatched"),
+                status=status[0],
+            )
@@ -14,28 +14,89 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import geopy
-import geopy.distance
+import os
 import sqlalchemy
 import uuid
 import hashlib
 
+from datetime import datetime, timedelta, timezone
 from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
 from databases.core import Database
 from typing import Dict, List, Set, Tuple, Union
 
 from .db import metadata
+from .schemas import decode_cursor, encode_cursor
+from .cache import MISSING, Cache
+from .recent import Recent
+from .nearest import Locations
+from .metrics import timed
+from .profiling import traced
+from .functions import (
+    GEOHASH_ALPHABET,
+    GEOHASH_PRECISION,
+    as_utc,
+    bounds,
+    bucket,
+    ceil,
+    floor,
+    geohash,
+    geohash_cells,
+    haversine,
+)
+
+
+STATS = ["pm1dot0", "pm2dot5", "pm10", "humidity", "temperature", "pressure", "co2"]
+IDENTITY = ["sensor", "source", "description", "latitude", "longitude"]
+AGGREGATES = [
+    ("sum", sqlalchemy.Float),
+    ("count", sqlalchemy.Integer),
+    ("minimum", sqlalchemy.Float),
+    ("maximum", sqlalchemy.Float),
+]
+
+# Rollup resolutions in seconds, each one is built from the previous one
+RESOLUTIONS = [60, 3600, 86400]
 
 
+devices = sqlalchemy.Table(
+    "devices",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("sensor", sqlalchemy.String),
+    sqlalchemy.Column("source", sqlalchemy.String),
+    sqlalchemy.Column("description", sqlalchemy.String, nullable=True),
+    sqlalchemy.Column("longitude", sqlalchemy.Float),
+    sqlalchemy.Column("latitude", sqlalchemy.Float),
+    sqlalchemy.Column("geohash", sqlalchemy.String(GEOHASH_PRECISION), nullable=True),
+    sqlalchemy.Column("ingested", sqlalchemy.DateTime(timezone=True), nullable=True),
+    sqlalchemy.Index("ix_devices_source", "source"),
+    sqlalchemy.Index("ix_devices_geohash", "geohash"),
+    sqlalchemy.Index("ix_devices_ingested", "ingested"),
+)
+# One device per identity, missing and empty descriptions are the same one
+sqlalchemy.Index(
+    "ux_devices_identity",
+    devices.c.sensor,
+    devices.c.source,
+    func.coalesce(devices.c.description, ""),
+    devices.c.latitude,
+    devices.c.longitude,
+    unique=True,
+)
+
 measurements = sqlalchemy.Table(
     "measurements",
     metadata,
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
     sqlalchemy.Column("recorded", sqlalchemy.DateTime(timezone=True)),
-    sqlalchemy.Column("sensor", sqlalchemy.String),
-    sqlalchemy.Column("source", sqlalchemy.String),
+    sqlalchemy.Column(
+        "device_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("devices.id"),
+        nullable=False,
+    ),
     sqlalchemy.Column("version", sqlalchemy.String, nullable=True),
-    sqlalchemy.Column("description", sqlalchemy.String, nullable=True),
     sqlalchemy.Column("pm1dot0", sqlalchemy.Float, nullable=True),
     sqlalchemy.Column("pm2dot5", sqlalchemy.Float, nullable=True),
     sqlalchemy.Column("pm10", sqlalchemy.Float, nullable=True),
@@ -43,14 +104,14 @@ measurements = sqlalchemy.Table(
     sqlalchemy.Column("temperature", sqlalchemy.Float, nullable=True),
     sqlalchemy.Column("pressure", sqlalchemy.Float, nullable=True),
     sqlalchemy.Column("co2", sqlalchemy.Float, nullable=True),
-    sqlalchemy.Column("longitude", sqlalchemy.Float),
-    sqlalchemy.Column("latitude", sqlalchemy.Float),
     sqlalchemy.Column(
         "provider_id",
         sqlalchemy.Integer,
         sqlalchemy.ForeignKey("providers.id", ondelete="CASCADE"),
         nullable=True,
     ),
+    sqlalchemy.Index("ix_measurements_recorded_id", "recorded", "id"),
+    sqlalchemy.Index("ix_measurements_device_id_recorded", "device_id", "recorded"),
 )
 
 providers = sqlalchemy.Table(
@@ -61,12 +122,143 @@ providers = sqlalchemy.Table(
     sqlalchemy.Column("api_key_hash", sqlalchemy.String(length=65), nullable=False),
 )
 
+rollups = sqlalchemy.Table(
+    "rollups",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("resolution", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("bucket", sqlalchemy.DateTime(timezone=True), nullable=False),
+    sqlalchemy.Column(
+        "device_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("devices.id"),
+        nullable=False,
+    ),
+    sqlalchemy.Column(
+        "provider_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("providers.id", ondelete="CASCADE"),
+        nullable=True,
+    ),
+    *[
+        sqlalchemy.Column(f"{stat}_{aggregate}", type_, nullable=True)
+        for stat in STATS
+        for aggregate, type_ in AGGREGATES
+    ],
+    sqlalchemy.Index("ix_rollups_resolution_bucket", "resolution", "bucket"),
+    sqlalchemy.Index(
+        "ix_rollups_resolution_device_id_bucket", "resolution", "device_id", "bucket"
+    ),
+)
+
+# Maps API key hashes to provider ids, including unknown hashes as None. This is
+# per worker, so revoking a key only takes effect right away in the worker that
+# handled the revocation, the other ones will notice once the TTL expires.
+keys_cache = Cache(
+    size=int(os.environ.get("LINKA_AUTH_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("LINKA_AUTH_CACHE_TTL", 60)),
+)
+
+# Maps device identities to their ids, which never change
+devices_cache = Cache(
+    size=int(os.environ.get("LINKA_DEVICES_CACHE_SIZE", 65536)),
+    ttl=float(os.environ.get("LINKA_DEVICES_CACHE_TTL", 86400)),
+)
+
+# Measurements from the last LINKA_RECENT_SPAN seconds, to answer the default
+# window without the database. It only sees what this worker stores, so it is
+# only complete when a single worker handles all the measurements.
+recent = Recent(
+    span=float(os.environ.get("LINKA_RECENT_SPAN", 0)),
+    stats=STATS,
+    identity=IDENTITY,
+)
+
+# Every sensor location seen, to find the nearest ones to a point. This is per
+# worker, so sensors stored by other workers only show up once it's reloaded,
+# every LINKA_LOCATIONS_INTERVAL seconds if the devices changed meanwhile.
+locations = Locations(identity=IDENTITY)
+
+
+# Older SQLite builds limit statements to this many bound parameters
+SQLITE_MAX_VARIABLES = 999
+
+# Arbitrary key for the PostgreSQL advisory locks that serialize stores per device
+ROLLUPS_LOCK = 5146510
+
+# Rows checked against the exact distance at once while streaming
+WITHIN_CHUNK_SIZE = 1000
+
+# Measurements older than LINKA_RETENTION_DAYS are only kept as hourly rollups,
+# every worker has to agree on it since queries read them from then on
+RETENTION_DAYS = float(os.environ.get("LINKA_RETENTION_DAYS", 0))
+RETENTION_BATCH_SIZE = int(os.environ.get("LINKA_RETENTION_BATCH_SIZE", 5000))
+RETENTION_RESOLUTION = 3600
+
 
 class Measurement:
     @staticmethod
+    def columns():
+        return [c.name for c in measurements.columns if not c.primary_key]
+
+    @staticmethod
+    @timed("store")
     async def store(db, measurements_):
-        insert = measurements.insert()
-        await db.execute_many(insert, measurements_)
+        if not measurements_:
+            return
+
+        async with db.transaction():
+            identified = await Device.identify(db, measurements_)
+            await Measurement.lock(db, {m["device_id"] for m in measurements_})
+
+            if db.url.dialect == "postgresql" and db.url.driver in ("", "asyncpg"):
+                await Measurement.copy(db, measurements_)
+            elif db.url.dialect == "sqlite":
+                await Measurement.insert_values(db, measurements_)
+            else:
+                await db.execute_many(measurements.insert(), measurements_)
+
+            await Rollup.update(db, measurements_)
+            await Device.touch(db, {m["device_id"] for m in measurements_})
+
+        # Only once they are committed
+        for identity, id in identified.items():
+            devices_cache.set(identity, id)
+
+    @staticmethod
+    async def lock(db, devices_):
+        # Concurrent stores for the same devices could otherwise count the same
+        # rows twice in their rollups, locked in order so they can't deadlock
+        if db.url.dialect != "postgresql" or not devices_:
+            return
+
+        select = sqlalchemy.select(
+            [func.pg_advisory_xact_lock(ROLLUPS_LOCK, devices.c.id)]
+        )
+        select = select.where(devices.c.id.in_(sorted(devices_)))
+        select = select.order_by(devices.c.id)
+        # All of the rows, execute would only fetch the first lock
+        await db.fetch_all(select)
+
+    @staticmethod
+    async def copy(db, measurements_):
+        columns = Measurement.columns()
+        records = [tuple(m.get(c) for c in columns) for m in measurements_]
+
+        async with db.connection() as connection:
+            await connection.raw_connection.copy_records_to_table(
+                measurements.name, records=records, columns=columns
+            )
+
+    @staticmethod
+    async def insert_values(db, measurements_):
+        columns = Measurement.columns()
+        rows = [{c: m.get(c) for c in columns} for m in measurements_]
+        size = max(SQLITE_MAX_VARIABLES // len(columns), 1)
+
+        for index in range(0, len(rows), size):
+            insert = measurements.insert().values(rows[index : index + size])
+            await db.execute(insert)
 
     @staticmethod
     def filter(select, query):
@@ -74,79 +266,756 @@ class Measurement:
             select = select.where(measurements.c.recorded >= query.start)
         if query.end is not None:
             select = select.where(measurements.c.recorded <= query.end)
-        if query.source is not None:
-            select = select.where(measurements.c.source == query.source)
-        if query.distance is not None:
-            longitude = query.longitude if query.longitude is not None else 0.0
-            latitude = query.latitude if query.latitude is not None else 0.0
-            location = geopy.Point(latitude, longitude)
-            distance = geopy.distance.distance(kilometers=query.distance)
 
-            north = distance.destination(point=location, bearing=0)
-            east = distance.destination(point=location, bearing=90)
-            south = distance.destination(point=location, bearing=180)
-            west = distance.destination(point=location, bearing=270)
+        return Measurement.filter_location(select, query, measurements)
 
-            select = select.where(measurements.c.latitude <= north.latitude)
-            select = select.where(measurements.c.longitude <= east.longitude)
-            select = select.where(measurements.c.latitude >= south.latitude)
-            select = select.where(measurements.c.longitude >= west.longitude)
+    @staticmethod
+    def filter_location(select, query, table):
+        matching = Device.matching(query)
+        if matching is not None:
+            select = select.where(table.c.device_id.in_(matching))
 
         return select
 
     @staticmethod
+    def within(records, query):
+        # The box corners are farther than the distance, drop what's out there
+        if query.distance is None or not records:
+            return records
+
+        longitude = query.longitude if query.longitude is not None else 0.0
+        latitude = query.latitude if query.latitude is not None else 0.0
+        distances = haversine(
+            latitude,
+            longitude,
+            [r.latitude for r in records],
+            [r.longitude for r in records],
+        )
+
+        return [r for r, d in zip(records, distances.tolist()) if d <= query.distance]
+
+    @staticmethod
+    async def warm(db):
+        if not recent.enabled:
+            return
+
+        select = Measurement.joined()
+        select = select.where(measurements.c.recorded >= recent.cutoff())
+        records = await db.fetch_all(select)
+
+        columns = Measurement.columns() + IDENTITY
+        recent.warm([{c: r[c] for c in columns} for r in records])
+
+    @staticmethod
+    async def locate(db):
+        # Devices with measurements left, the daily rollups are the smallest
+        measured = sqlalchemy.select([rollups.c.device_id])
+        measured = measured.where(rollups.c.resolution == RESOLUTIONS[-1])
+
+        select = sqlalchemy.select([devices.c[c] for c in IDENTITY])
+        select = select.where(devices.c.id.in_(measured))
+
+        # Read first, so anything ingested while loading is reloaded next time
+        ingested = await db.fetch_val(sqlalchemy.select([func.max(devices.c.ingested)]))
+        records = await db.fetch_all(select)
+
+        locations.clear()
+        locations.add(records)
+        locations.build()
+        locations.version = ingested
+
+    @staticmethod
+    async def relocate(db):
+        # Reloads the locations if any worker changed measurements since
+        ingested = await db.fetch_val(sqlalchemy.select([func.max(devices.c.ingested)]))
+        if ingested != locations.version:
+            await Measurement.locate(db)
+
+    @staticmethod
+    async def ingested(db, query):
+        # When measurements of the devices in the query last changed, if ever
+        latest = func.max(devices.c.ingested)
+        matching = Device.matching(query)
+        if matching is None:
+            select = sqlalchemy.select([latest])
+        else:
+            select = matching.with_only_columns([latest])
+
+        with traced(select):
+            ingested = await db.fetch_val(select)
+        return as_utc(ingested) if ingested is not None else None
+
+    @staticmethod
+    @timed("stats")
     async def stats(db, query):
-        measurements_dict = {
-            "pm1dot0": measurements.c.pm1dot0,
-            "pm2dot5": measurements.c.pm2dot5,
-            "pm10": measurements.c.pm10,
-            "humidity": measurements.c.humidity,
-            "temperature": measurements.c.temperature,
-            "pressure": measurements.c.pressure,
-            "co2": measurements.c.co2,
-        }
-        measurements_stats = [
-            measurements.c.sensor,
-            measurements.c.source,
-            measurements.c.description,
-            measurements.c.latitude,
-            measurements.c.longitude,
-        ]
-        for measurement in measurements_dict.keys():
-            measurements_stats.extend(
+        if recent.covers(query):
+            return recent.stats(query)
+
+        partials = sqlalchemy.union_all(*Rollup.partials(query)).subquery()
+
+        merged = sqlalchemy.select([partials.c.device_id] + Rollup.merged(partials))
+        merged = merged.group_by(partials.c.device_id)
+
+        select = Device.described(merged.subquery())
+        with traced(select):
+            records = await db.fetch_all(select)
+        return Measurement.within(records, query)
+
+    @staticmethod
+    @timed("series")
+    async def series(db, query):
+        stats = query.fields.split(",")
+        partials = sqlalchemy.union_all(*Rollup.series(query)).subquery()
+
+        select = sqlalchemy.select(
+            [partials.c.bucket.label("recorded")] + Rollup.merged(partials, stats)
+        )
+        select = select.group_by(partials.c.bucket)
+        select = select.order_by(sqlalchemy.asc(partials.c.bucket))
+
+        with traced(select):
+            return await db.fetch_all(select)
+
+    @staticmethod
+    @timed("hourly")
+    async def hourly(db, query, hours, stats=STATS):
+        select = Rollup.hourly(query, hours, stats)
+        with traced(select):
+            records = await db.fetch_all(select)
+        return Measurement.within(records, query)
+
+    @staticmethod
+    def joined():
+        identity = [devices.c[c] for c in IDENTITY]
+        select = sqlalchemy.select(list(measurements.columns) + identity)
+        return select.select_from(
+            measurements.join(devices, measurements.c.device_id == devices.c.id)
+        )
+
+    @staticmethod
+    def listing(query):
+        select = Measurement.joined()
+        select = Measurement.filter(select, query)
+
+        if query.limit is None and query.cursor is None:
+            return select.order_by(devices.c.description.asc().nulls_last())
+
+        # Pages are sorted by (recorded, id) so the next one can seek from the
+        # last row of the previous one, instead of skipping over an OFFSET
+        select = select.order_by(
+            sqlalchemy.asc(measurements.c.recorded),
+            sqlalchemy.asc(measurements.c.id),
+        )
+        if query.cursor is not None:
+            key = sqlalchemy.tuple_(measurements.c.recorded, measurements.c.id)
+            select = select.where(key > decode_cursor(query.cursor))
+        if query.limit is not None:
+            select = select.limit(query.limit)
+
+        return select
+
+    @staticmethod
+    @timed("retrieve")
+    async def retrieve(db, query):
+        if recent.covers(query):
+            return recent.select(query)
+
+        select = Measurement.listing(query)
+        with traced(select):
+            records = await db.fetch_all(select)
+        return Measurement.within(records, query)
+
+    @staticmethod
+    @timed("page")
+    async def page(db, query):
+        select = Measurement.listing(query)
+        with traced(select):
+            records = await db.fetch_all(select)
+
+        # Pages can come out short after the distance check, but not end early
+        cursor = None
+        if len(records) == query.limit:
+            cursor = encode_cursor(records[-1]["recorded"], records[-1]["id"])
+
+        return Measurement.within(records, query), cursor
+
+    @staticmethod
+    @timed("iterate")
+    async def iterate(db, query):
+        if recent.covers(query):
+            for record in recent.select(query):
+                yield record
+            return
+
+        select = Measurement.listing(query)
+        if query.distance is None:
+            with traced(select):
+                async for record in db.iterate(select):
+                    yield record
+            return
+
+        records = []
+        with traced(select):
+            async for record in db.iterate(select):
+                records.append(record)
+                if len(records) >= WITHIN_CHUNK_SIZE:
+                    for nearby in Measurement.within(records, query):
+                        yield nearby
+                    records = []
+
+        for record in Measurement.within(records, query):
+            yield record
+
+
+class Rollup:
+    @staticmethod
+    def aggregates(table, stats=STATS):
+        columns = []
+
+        for stat in stats:
+            if table is measurements:
+                column = table.c[stat]
+                columns.extend(
+                    [
+                        func.sum(column),
+                        func.count(column),
+                        func.min(column),
+                        func.max(column),
+                    ]
+                )
+            else:
+                columns.extend(
+                    [
+                        func.sum(table.c[f"{stat}_sum"]),
+                        func.sum(table.c[f"{stat}_count"]),
+                        func.min(table.c[f"{stat}_minimum"]),
+                        func.max(table.c[f"{stat}_maximum"]),
+                    ]
+                )
+
+        names = [f"{stat}_{aggregate}" for stat in stats for aggregate, _ in AGGREGATES]
+        return [column.label(name) for column, name in zip(columns, names)]
+
+    @staticmethod
+    def merged(partials, stats=STATS):
+        columns = []
+
+        for stat in stats:
+            count = func.nullif(func.sum(partials.c[f"{stat}_count"]), 0)
+            columns.extend(
                 [
-                    func.avg(measurements_dict[measurement]).label(
-                        f"{measurement}_average"
-                    ),
-                    func.max(measurements_dict[measurement]).label(
-                        f"{measurement}_maximum"
-                    ),
-                    func.min(measurements_dict[measurement]).label(
-                        f"{measurement}_minimum"
+                    (func.sum(partials.c[f"{stat}_sum"]) / count).label(
+                        f"{stat}_average"
                     ),
+                    func.max(partials.c[f"{stat}_maximum"]).label(f"{stat}_maximum"),
+                    func.min(partials.c[f"{stat}_minimum"]).label(f"{stat}_minimum"),
+                ]
+            )
+
+        return columns
+
+    @staticmethod
+    def segments(start, end, resolutions=RESOLUTIONS):
+        # Covers start..end with the coarsest rollups, leaving raw rows for the edges
+        def cover(start, end, resolutions):
+            if not resolutions:
+                return [(None, start, end)]
+
+            lower = ceil(start, resolutions[0])
+            upper = floor(end, resolutions[0])
+            if lower >= upper:
+                return cover(start, end, resolutions[1:])
+
+            return (
+                cover(start, lower, resolutions[1:])
+                + [(resolutions[0], lower, upper)]
+                + cover(upper, end, resolutions[1:])
+            )
+
+        return cover(start, end, sorted(resolutions, reverse=True))
+
+    @staticmethod
+    def ranges(start, end, resolutions=RESOLUTIONS):
+        # Tables and conditions to read start..end from, with an open end if None
+        upper_bound = as_utc(end) if end is not None else datetime.now(timezone.utc)
+        start = as_utc(start)
+        segments = []
+
+        # Past the horizon there are only whole hours left
+        horizon = Retention.horizon()
+        coarse = [r for r in resolutions if r >= RETENTION_RESOLUTION]
+        if horizon is not None and coarse and start < horizon:
+            lower = floor(start, RETENTION_RESOLUTION)
+            upper = min(ceil(upper_bound, RETENTION_RESOLUTION), horizon)
+            segments = [
+                s for s in Rollup.segments(lower, upper, coarse) if s[0] is not None
+            ]
+            start = upper
+
+        segments += Rollup.segments(start, upper_bound, resolutions)
+
+        ranges = []
+        for index, (resolution, lower, upper) in enumerate(segments):
+            last = index == len(segments) - 1
+
+            if resolution is not None:
+                conditions = [
+                    rollups.c.resolution == resolution,
+                    rollups.c.bucket >= lower,
+                    rollups.c.bucket < upper,
                 ]
+                ranges.append((rollups, rollups.c.bucket, conditions))
+                continue
+            if lower >= upper and not last:
+                continue
+
+            # Only the last edge includes the end
+            conditions = [measurements.c.recorded >= lower]
+            if not last:
+                conditions.append(measurements.c.recorded < upper)
+            elif end is not None:
+                conditions.append(measurements.c.recorded <= upper)
+            ranges.append((measurements, measurements.c.recorded, conditions))
+
+        return ranges
+
+    @staticmethod
+    def partials(query):
+        if query.start is None:
+            device = measurements.c.device_id
+            select = sqlalchemy.select([device] + Rollup.aggregates(measurements))
+            select = select.group_by(device)
+            return [Measurement.filter(select, query)]
+
+        partials = []
+        for table, _, conditions in Rollup.ranges(query.start, query.end):
+            device = table.c.device_id
+            select = sqlalchemy.select([device] + Rollup.aggregates(table))
+            select = select.where(*conditions)
+            select = select.group_by(device)
+            partials.append(Measurement.filter_location(select, query, table))
+
+        return partials
+
+    @staticmethod
+    def series(query):
+        stats = query.fields.split(",")
+        seconds = query.bucket.seconds
+        # Only rollups that fit whole into a bucket can be used
+        resolutions = [r for r in RESOLUTIONS if seconds % r == 0]
+
+        partials = []
+        for table, recorded, conditions in Rollup.ranges(
+            query.start, query.end, resolutions
+        ):
+            bucket_ = bucket(recorded, seconds)
+            select = sqlalchemy.select(
+                [bucket_.label("bucket")] + Rollup.aggregates(table, stats)
             )
+            select = select.where(*conditions)
+            select = select.group_by(bucket_)
+            partials.append(Measurement.filter_location(select, query, table))
 
-        select = sqlalchemy.select(measurements_stats)
-        select = select.group_by(
-            measurements.c.sensor,
-            measurements.c.source,
-            measurements.c.description,
-            measurements.c.latitude,
-            measurements.c.longitude,
+        return partials
+
+    @staticmethod
+    def hourly(query, hours, stats=STATS):
+        # Averages of the last hours up to the end, including the current hour
+        end = floor(query.end or datetime.now(timezone.utc), 3600)
+        start = end - timedelta(hours=hours - 1)
+        grouping = [rollups.c.device_id, rollups.c.bucket]
+
+        select = sqlalchemy.select(grouping + Rollup.merged(rollups, stats))
+        select = select.where(rollups.c.resolution == 3600)
+        select = select.where(rollups.c.bucket >= start)
+        select = select.where(rollups.c.bucket <= end)
+        select = select.group_by(*grouping)
+        select = Measurement.filter_location(select, query, rollups)
+
+        return Device.described(select.subquery())
+
+    @staticmethod
+    async def update(db, measurements_):
+        horizon = Retention.horizon()
+        if horizon is not None:
+            older = [m for m in measurements_ if as_utc(m["recorded"]) < horizon]
+            if older:
+                await Rollup.merge(db, older)
+                measurements_ = [
+                    m for m in measurements_ if as_utc(m["recorded"]) >= horizon
+                ]
+            if not measurements_:
+                return
+
+        touched = {}
+        for measurement in measurements_:
+            recorded = floor(measurement["recorded"], RESOLUTIONS[0])
+            touched.setdefault(measurement["device_id"], set()).add(recorded)
+
+        await Rollup.cascade(db, touched, RESOLUTIONS)
+
+    @staticmethod
+    async def merge(db, measurements_):
+        # Their hours were compacted already, so these are added on top of them
+        groups = {}
+        for measurement in measurements_:
+            key = (
+                floor(measurement["recorded"], RETENTION_RESOLUTION),
+                measurement["device_id"],
+                measurement.get("provider_id"),
+            )
+            values = groups.setdefault(key, {stat: [] for stat in STATS})
+            for stat in STATS:
+                if measurement.get(stat) is not None:
+                    values[stat].append(measurement[stat])
+
+        rows = []
+        for (bucket_, device_id, provider_id), values in groups.items():
+            row = {
+                "bucket": bucket_,
+                "resolution": RETENTION_RESOLUTION,
+                "device_id": device_id,
+                "provider_id": provider_id,
+            }
+            for stat, stat_values in values.items():
+                row[f"{stat}_sum"] = sum(stat_values) if stat_values else None
+                row[f"{stat}_count"] = len(stat_values)
+                row[f"{stat}_minimum"] = min(stat_values, default=None)
+                row[f"{stat}_maximum"] = max(stat_values, default=None)
+            rows.append(row)
+
+        await db.execute_many(rollups.insert(), rows)
+
+        touched = {}
+        for bucket_, device_id, _ in groups:
+            touched.setdefault(device_id, set()).add(bucket_)
+
+        await Rollup.cascade(
+            db,
+            touched,
+            [r for r in RESOLUTIONS if r > RETENTION_RESOLUTION],
+            RETENTION_RESOLUTION,
         )
-        select = select.order_by(sqlalchemy.asc(measurements.c.description))
-        select = Measurement.filter(select, query)
 
-        return await db.fetch_all(select)
+    @staticmethod
+    def spans(touched, resolution):
+        # Devices by each run of consecutive buckets their times fall in, so
+        # devices that share one are rebuilt together
+        step = timedelta(seconds=resolution)
+        spans = {}
+
+        for device_id, times in touched.items():
+            buckets = sorted({floor(t, resolution) for t in times})
+            start = previous = buckets[0]
+            for bucket_ in buckets[1:]:
+                if bucket_ - previous > step:
+                    spans.setdefault((start, previous + step), []).append(device_id)
+                    start = bucket_
+                previous = bucket_
+            spans.setdefault((start, previous + step), []).append(device_id)
+
+        return spans
 
     @staticmethod
-    async def retrieve(db, query):
-        select = measurements.select()
-        select = select.order_by(sqlalchemy.asc(measurements.c.description))
-        select = Measurement.filter(select, query)
+    async def cascade(db, touched, resolutions, previous=None):
+        # Rebuilds the buckets each device touched, every resolution from the
+        # previous one
+        size = SQLITE_MAX_VARIABLES // 2
+
+        for resolution in resolutions:
+            spans = Rollup.spans(touched, resolution)
+            for (start, end), devices_ in sorted(spans.items()):
+                devices_ = sorted(devices_)
+                for index in range(0, len(devices_), size):
+                    await Rollup.rebuild(
+                        db,
+                        devices_[index : index + size],
+                        resolution,
+                        previous,
+                        start,
+                        end,
+                    )
+            previous = resolution
+
+    @staticmethod
+    async def rebuild(db, devices_, resolution, previous, start, end):
+        delete = rollups.delete()
+        delete = delete.where(rollups.c.resolution == resolution)
+        delete = delete.where(rollups.c.device_id.in_(devices_))
+        delete = delete.where(rollups.c.bucket >= start)
+        delete = delete.where(rollups.c.bucket < end)
+
+        table = measurements if previous is None else rollups
+        recorded = measurements.c.recorded if previous is None else rollups.c.bucket
+        carried = ["device_id", "provider_id"]
+        identity = [table.c[c] for c in carried]
+        bucket_ = bucket(recorded, resolution)
+
+        select = sqlalchemy.select(
+            [bucket_, sqlalchemy.literal_column(str(resolution))]
+            + identity
+            + Rollup.aggregates(table)
+        )
+        select = select.where(table.c.device_id.in_(devices_))
+        select = select.where(recorded >= start)
+        select = select.where(recorded < end)
+        if previous is not None:
+            select = select.where(rollups.c.resolution == previous)
+        select = select.group_by(bucket_, *identity)
+
+        names = [f"{stat}_{aggregate}" for stat in STATS for aggregate, _ in AGGREGATES]
+        columns = ["bucket", "resolution"] + carried + names
+        insert = rollups.insert().from_select(columns, select)
+
+        await db.execute(delete)
+        await db.execute(insert)
+
+
+class Retention:
+    @staticmethod
+    def horizon():
+        # Whole hours before it only have hourly rollups, None keeps everything
+        if RETENTION_DAYS <= 0:
+            return None
 
-        return await db.fetch_all(select)
+        cutoff = datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)
+        return floor(cutoff, RETENTION_RESOLUTION)
+
+    @staticmethod
+    async def compact(db, size=RETENTION_BATCH_SIZE):
+        # Deletes measurements past the horizon a batch at a time, returns how many
+        horizon = Retention.horizon()
+        if horizon is None:
+            return 0
+
+        recorded = measurements.c.recorded
+        select = sqlalchemy.select(
+            [measurements.c.id, measurements.c.device_id, recorded]
+        )
+        select = select.where(recorded < horizon)
+        select = select.order_by(recorded, measurements.c.id).limit(size)
+
+        deleted = 0
+        while True:
+            async with db.transaction():
+                records = await db.fetch_all(select)
+                await Measurement.lock(db, {r["device_id"] for r in records})
+                if records:
+                    await Retention.downsample(db, records)
+                    await Retention.delete(
+                        db, measurements, [r["id"] for r in records], recorded < horizon
+                    )
+                    await Device.touch(db, {r["device_id"] for r in records})
+
+            deleted += len(records)
+            if len(records) < size:
+                break
+
+        # Nothing reads finer rollups past the horizon either
+        select = sqlalchemy.select([rollups.c.id])
+        select = select.where(rollups.c.resolution < RETENTION_RESOLUTION)
+        select = select.where(rollups.c.bucket < horizon)
+        select = select.limit(size)
+
+        while True:
+            ids = [r["id"] for r in await db.fetch_all(select)]
+            await Retention.delete(db, rollups, ids)
+            if len(ids) < size:
+                break
+
+        return deleted
+
+    @staticmethod
+    async def downsample(db, records):
+        # Stores keep the hourly rollups, so this only fills in the missing ones
+        hours = {
+            (r["device_id"], floor(r["recorded"], RETENTION_RESOLUTION))
+            for r in records
+        }
+        devices_ = sorted({d for d, _ in hours})
+        size = SQLITE_MAX_VARIABLES // 2
+
+        present = set()
+        for index in range(0, len(devices_), size):
+            select = sqlalchemy.select([rollups.c.device_id, rollups.c.bucket])
+            select = select.where(rollups.c.resolution == RETENTION_RESOLUTION)
+            select = select.where(
+                rollups.c.device_id.in_(devices_[index : index + size])
+            )
+            select = select.where(rollups.c.bucket >= min(h for _, h in hours))
+            select = select.where(rollups.c.bucket <= max(h for _, h in hours))
+            present.update(
+                (r["device_id"], as_utc(r["bucket"]))
+                for r in await db.fetch_all(select)
+            )
+
+        missing = {}
+        for device_id, hour in hours - present:
+            missing.setdefault(device_id, set()).add(hour)
+
+        await Rollup.cascade(
+            db, missing, [r for r in RESOLUTIONS if r >= RETENTION_RESOLUTION]
+        )
+
+    @staticmethod
+    async def delete(db, table, ids, *conditions):
+        size = SQLITE_MAX_VARIABLES // 2
+
+        for index in range(0, len(ids), size):
+            delete = table.delete()
+            delete = delete.where(table.c.id.in_(ids[index : index + size]))
+            await db.execute(delete.where(*conditions))
+
+
+class Device:
+    @staticmethod
+    async def identify(db, measurements_):
+        # Sets the device id of every measurement, returns the ones looked up
+        identities = {tuple(m[c] for c in IDENTITY) for m in measurements_}
+        ids = {i: devices_cache.get(i) for i in identities}
+        unknown = [i for i, id in ids.items() if id is MISSING]
+
+        found = await Device.find(db, unknown)
+        missing = [i for i in unknown if i not in found]
+        if missing:
+            # Other workers may be inserting the same ones, whoever is first wins
+            await db.execute_many(
+                Device.insert(db),
+                [
+                    {
+                        **dict(zip(IDENTITY, i)),
+                        "geohash": geohash(
+                            i[IDENTITY.index("latitude")],
+                            i[IDENTITY.index("longitude")],
+                        ),
+                    }
+                    for i in {Device.normalized(i): i for i in missing}.values()
+                ],
+            )
+            found.update(await Device.find(db, missing))
+
+        ids.update(found)
+        for measurement in measurements_:
+            measurement["device_id"] = ids[tuple(measurement[c] for c in IDENTITY)]
+
+        return found
+
+    @staticmethod
+    def normalized(identity):
+        # As compared by the unique index
+        return tuple(
+            "" if c == "description" and v is None else v
+            for c, v in zip(IDENTITY, identity)
+        )
+
+    @staticmethod
+    def insert(db):
+        if db.url.dialect == "postgresql":
+            return postgresql.insert(devices).on_conflict_do_nothing()
+        if db.url.dialect == "sqlite":
+            return sqlite.insert(devices).on_conflict_do_nothing()
+        return devices.insert()
+
+    @staticmethod
+    async def find(db, identities):
+        found = {}
+        size = SQLITE_MAX_VARIABLES // len(IDENTITY)
+        columns = [
+            func.coalesce(devices.c[c], "") if c == "description" else devices.c[c]
+            for c in IDENTITY
+        ]
+
+        for index in range(0, len(identities), size):
+            wanted = {}
+            for identity in identities[index : index + size]:
+                wanted.setdefault(Device.normalized(identity), []).append(identity)
+
+            # Compared the same way as the unique index, so it's used
+            conditions = [
+                sqlalchemy.and_(*[c == v for c, v in zip(columns, identity)])
+                for identity in wanted
+            ]
+            select = sqlalchemy.select(
+                [devices.c.id] + [devices.c[c] for c in IDENTITY]
+            )
+            select = select.where(sqlalchemy.or_(*conditions))
+
+            for record in await db.fetch_all(select):
+                identity = Device.normalized(tuple(record[c] for c in IDENTITY))
+                for requested in wanted.get(identity, []):
+                    found[requested] = record["id"]
+
+        return found
+
+    @staticmethod
+    async def touch(db, ids=None):
+        # Marks the devices whose measurements changed, all of them without ids.
+        # Marks only move forward, even across workers with different clocks.
+        latest = await db.fetch_val(sqlalchemy.select([func.max(devices.c.ingested)]))
+        ingested = datetime.now(timezone.utc)
+        if latest is not None:
+            ingested = max(ingested, as_utc(latest) + timedelta(microseconds=1))
+
+        if ids is None:
+            await db.execute(devices.update().values(ingested=ingested))
+            return
+
+        ids = sorted(ids)
+        size = SQLITE_MAX_VARIABLES - 1
+        for index in range(0, len(ids), size):
+            update = devices.update()
+            update = update.where(devices.c.id.in_(ids[index : index + size]))
+            await db.execute(update.values(ingested=ingested))
+
+    @staticmethod
+    def matching(query):
+        # Ids of the devices at the source or distance, None if any will do
+        source = getattr(query, "source", None)
+        distance = getattr(query, "distance", None)
+        if source is None and distance is None:
+            return None
+
+        select = sqlalchemy.select([devices.c.id])
+        if source is not None:
+            select = select.where(devices.c.source == source)
+        if distance is not None:
+            longitude = query.longitude if query.longitude is not None else 0.0
+            latitude = query.latitude if query.latitude is not None else 0.0
+            north, east, south, west = bounds(latitude, longitude, distance)
+
+            select = select.where(devices.c.latitude <= north)
+            select = select.where(devices.c.longitude <= east)
+            select = select.where(devices.c.latitude >= south)
+            select = select.where(devices.c.longitude >= west)
+
+            # Geohashes sort by prefix, so each cell is a range of the index
+            cells = geohash_cells(north, east, south, west)
+            if cells is not None:
+                padding = GEOHASH_ALPHABET[-1] * GEOHASH_PRECISION
+                select = select.where(
+                    sqlalchemy.or_(
+                        *[
+                            devices.c.geohash.between(
+                                c, (c + padding)[:GEOHASH_PRECISION]
+                            )
+                            for c in cells
+                        ]
+                    )
+                )
+
+        return select
+
+    @staticmethod
+    def described(grouped):
+        # Adds the device identity to rows grouped by device id
+        identity = [devices.c[c] for c in IDENTITY]
+        rest = [c for c in grouped.columns if c.name != "device_id"]
+
+        select = sqlalchemy.select(identity + rest)
+        select = select.select_from(
+            grouped.join(devices, grouped.c.device_id == devices.c.id)
+        )
+        return select.order_by(devices.c.description.asc().nulls_last())
 
 
 class Provider:
@@ -161,6 +1030,7 @@ class Provider:
         api_key_hash = hashlib.sha256(raw_api_key.encode("utf-8")).hexdigest()
         api_key = {"provider": provider, "api_key_hash": api_key_hash}
         await Provider.store(db, api_key)
+        keys_cache.invalidate(api_key_hash)
         return raw_api_key
 
     @staticmethod
@@ -177,13 +1047,27 @@ class Provider:
         delete = providers.delete()
         query = delete.where(providers.c.provider == provider)
         query = query.where(providers.c.api_key_hash == api_key_hash)
-        return await db.execute(query)
+        result = await db.execute(query)
+        keys_cache.invalidate(api_key_hash)
+        return result
 
     @staticmethod
     async def revoke_all_keys(db: Database, provider: str) -> bool:
-        delete = providers.delete()
-        query = delete.where(providers.c.provider == provider)
-        return await db.execute(query)
+        async with db.transaction():
+            # SQLite doesn't enforce foreign keys unless asked to on every
+            # connection, so their measurements wouldn't cascade
+            if db.url.dialect == "sqlite":
+                ids = sqlalchemy.select([providers.c.id])
+                ids = ids.where(providers.c.provider == provider)
+                for table in (measurements, rollups):
+                    await db.execute(table.delete().where(table.c.provider_id.in_(ids)))
+
+            delete = providers.delete()
+            query = delete.where(providers.c.provider == provider)
+            result = await db.execute(query)
+
+        keys_cache.invalidate()
+        return result
 
     @staticmethod
     async def get_all_keys(db: Database) -> Set[str]:
@@ -0,0 +1,119 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from scipy.spatial import cKDTree
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .functions import EARTH_RADIUS
+
+
+# Sensors added since the last build are searched by brute force until
+# there are this many of them, or an eighth of the indexed ones
+PENDING_MINIMUM = 256
+
+
+def to_unit_sphere(latitudes: List[float], longitudes: List[float]) -> np.ndarray:
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+
+    return np.column_stack(
+        [
+            np.cos(latitudes) * np.cos(longitudes),
+            np.cos(latitudes) * np.sin(longitudes),
+            np.sin(latitudes),
+        ]
+    ).reshape(-1, 3)
+
+
+def to_kilometers(chords: np.ndarray) -> np.ndarray:
+    # Straight line distances on the unit sphere to great circle ones
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chords / 2, 1.0))
+
+
+class Locations:
+    def __init__(self, identity: List[str]) -> None:
+        self.identity = identity
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._sensors)
+
+    def clear(self) -> None:
+        self._known: Set[Tuple] = set()
+        self._sensors: List[Tuple] = []
+        self._points = np.empty((0, 3))
+        self._tree: Optional[cKDTree] = None
+        self._indexed = 0
+        # Whatever the loader uses to tell when these are stale
+        self.version: Any = None
+
+    def add(self, rows: List[Any]) -> None:
+        sensors = []
+        for row in rows:
+            sensor = tuple(row[c] for c in self.identity)
+            if sensor in self._known:
+                continue
+
+            self._known.add(sensor)
+            sensors.append(sensor)
+
+        if not sensors:
+            return
+
+        latitude = self.identity.index("latitude")
+        longitude = self.identity.index("longitude")
+        points = to_unit_sphere(
+            [s[latitude] for s in sensors], [s[longitude] for s in sensors]
+        )
+
+        self._sensors.extend(sensors)
+        self._points = np.concatenate([self._points, points])
+
+        pending = len(self._sensors) - self._indexed
+        if pending > max(PENDING_MINIMUM, self._indexed // 8):
+            self.build()
+
+    def build(self) -> None:
+        self._tree = cKDTree(self._points) if len(self._sensors) else None
+        self._indexed = len(self._sensors)
+
+    def nearest(
+        self, latitude: float, longitude: float, n: int
+    ) -> List[Tuple[Dict[str, Any], float]]:
+        point = to_unit_sphere([latitude], [longitude])[0]
+        chords = np.empty(0)
+        positions = np.empty(0, dtype=np.int64)
+
+        if self._tree is not None:
+            k = min(n, self._indexed)
+            chords, positions = self._tree.query(point, k=[*range(1, k + 1)])
+
+        pending = self._points[self._indexed :]
+        if len(pending):
+            distances = np.linalg.norm(pending - point, axis=1)
+            chords = np.concatenate([chords, distances])
+            positions = np.concatenate(
+                [positions, np.arange(self._indexed, len(self._sensors))]
+            )
+
+        order = np.argsort(chords, kind="stable")[:n]
+        kilometers = to_kilometers(chords[order])
+
+        return [
+            (dict(zip(self.identity, self._sensors[p])), k)
+            for p, k in zip(positions[order].tolist(), kilometers.tolist())
+        ]
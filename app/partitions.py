@@ -0,0 +1,169 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime, timezone
+from databases.core import Database
+from sqlalchemy import text
+from typing import List, Optional, Tuple
+
+
+TABLE = "measurements"
+LEGACY = f"{TABLE}_legacy"
+DEFAULT = f"{TABLE}_default"
+
+
+def month(moment: datetime, offset: int = 0) -> datetime:
+    index = moment.year * 12 + moment.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def months(start: datetime, end: datetime) -> List[Tuple[datetime, datetime]]:
+    ranges = []
+    first = month(start)
+    while first < end:
+        ranges.append((first, month(first, 1)))
+        first = month(first, 1)
+
+    return ranges
+
+
+def name(first: datetime) -> str:
+    return f"{TABLE}_{first:%Y_%m}"
+
+
+def literal(moment: datetime) -> str:
+    # Partition bounds can't be bound parameters
+    return f"'{moment.astimezone(timezone.utc):%Y-%m-%d %H:%M:%S}+00'"
+
+
+def supported(db: Database) -> bool:
+    return db.url.dialect == "postgresql"
+
+
+async def partitioned(db: Database) -> bool:
+    query = text(
+        "SELECT count(*) FROM pg_partitioned_table "
+        f"WHERE partrelid = '{TABLE}'::regclass"
+    )
+    return bool(await db.fetch_val(query))
+
+
+async def covered(db: Database) -> Optional[datetime]:
+    # Where the last monthly partition ends, the default one has no bounds
+    query = text(
+        "SELECT max((regexp_match(pg_get_expr(c.relpartbound, c.oid), "
+        r"'TO \(''([^'']+)''\)'))[1]::timestamptz) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        f"WHERE i.inhparent = '{TABLE}'::regclass"
+    )
+    return await db.fetch_val(query)
+
+
+async def enable(db: Database) -> None:
+    # Turns the existing table into the first partition, from the very
+    # beginning to the end of the current month or the newest measurement
+    await db.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+
+    indexes = await db.fetch_all(
+        text(
+            "SELECT c.relname AS name, pg_get_indexdef(i.indexrelid) AS definition, "
+            "i.indisunique AS uniq FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            f"WHERE i.indrelid = '{TABLE}'::regclass"
+        )
+    )
+    constraints = await db.fetch_all(
+        text(
+            "SELECT conname AS name, pg_get_constraintdef(oid) AS definition "
+            f"FROM pg_constraint WHERE conrelid = '{TABLE}'::regclass "
+            "AND contype = 'f'"
+        )
+    )
+    newest = await db.fetch_val(text(f"SELECT max(recorded) FROM {TABLE}"))
+
+    for index in indexes:
+        legacy = index["name"].replace(TABLE, LEGACY, 1)
+        await db.execute(text(f"ALTER INDEX {index['name']} RENAME TO {legacy}"))
+    await db.execute(text(f"ALTER TABLE {TABLE} RENAME TO {LEGACY}"))
+
+    await db.execute(
+        text(
+            f"CREATE TABLE {TABLE} (LIKE {LEGACY} INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (recorded)"
+        )
+    )
+    for constraint in constraints:
+        await db.execute(
+            text(
+                f"ALTER TABLE {TABLE} ADD CONSTRAINT {constraint['name']} "
+                f"{constraint['definition']}"
+            )
+        )
+    # Unique indexes would have to include recorded, ids still come
+    # from the same sequence
+    for index in indexes:
+        if not index["uniq"]:
+            await db.execute(text(index["definition"]))
+
+    now = datetime.now(timezone.utc)
+    end = month(max(now, newest or now), 1)
+    await db.execute(
+        text(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {LEGACY} "
+            f"FOR VALUES FROM (MINVALUE) TO ({literal(end)})"
+        )
+    )
+    await db.execute(text(f"CREATE TABLE {DEFAULT} PARTITION OF {TABLE} DEFAULT"))
+
+
+async def create(db: Database, ahead: int) -> List[str]:
+    now = datetime.now(timezone.utc)
+    start = await covered(db) or month(now)
+    created = []
+
+    for first, last in months(start, month(now, ahead + 1)):
+        partition = name(first)
+        within = f"recorded >= {literal(first)} AND recorded < {literal(last)}"
+
+        # Measurements that landed in the default partition move over first,
+        # otherwise attaching the new partition would fail
+        await db.execute(
+            text(f"CREATE TABLE {partition} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        )
+        await db.execute(
+            text(
+                f"WITH moved AS (DELETE FROM {DEFAULT} WHERE {within} RETURNING *) "
+                f"INSERT INTO {partition} SELECT * FROM moved"
+            )
+        )
+        await db.execute(
+            text(
+                f"ALTER TABLE {TABLE} ATTACH PARTITION {partition} "
+                f"FOR VALUES FROM ({literal(first)}) TO ({literal(last)})"
+            )
+        )
+        created.append(partition)
+
+    return created
+
+
+async def maintain(db: Database, ahead: int, convert: bool = False) -> List[str]:
+    async with db.transaction():
+        if not await partitioned(db):
+            if not convert:
+                return []
+            await enable(db)
+
+        return await create(db, ahead)
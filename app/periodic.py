@@ -0,0 +1,55 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from typing import Any, Awaitable, Callable, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class Periodic:
+    def __init__(self, run: Callable[[], Awaitable[Any]], interval: float) -> None:
+        self.run = run
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._closing: Optional[asyncio.Event] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    async def start(self) -> None:
+        self._closing = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        # Lets a run in progress finish
+        self._closing.set()
+        await self._task
+
+    async def _loop(self) -> None:
+        while not self._closing.is_set():
+            try:
+                await self.run()
+            except Exception:
+                logger.exception("Failed to run %s", self.run)
+
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
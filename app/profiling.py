@@ -0,0 +1,184 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import time
+import uuid
+import pstats
+import random
+import logging
+import cProfile
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from starlette.responses import PlainTextResponse
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Functions listed in a returned profile
+PROFILE_LIMIT = 60
+
+# Statements run by the request being traced, None when it isn't
+statements: ContextVar[Optional[List[Tuple[Any, float]]]] = ContextVar(
+    "statements", default=None
+)
+
+
+@contextmanager
+def traced(statement: Any) -> Iterator[None]:
+    collected = statements.get()
+    if collected is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        collected.append((statement, time.perf_counter() - start))
+
+
+def header(scope: Dict, name: bytes) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+class Profiler:
+    # Profiles requests with the master key in X-Profile, one at a time
+    def __init__(self, app: Callable, enabled: bool, directory: Optional[str]) -> None:
+        self.app = app
+        self.enabled = enabled
+        self.directory = directory
+        self._busy = False
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http" or not self.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        key = header(scope, b"x-profile")
+        if not key or key != os.environ.get("LINKA_MASTER_KEY"):
+            await self.app(scope, receive, send)
+            return
+
+        if self._busy:
+            response = PlainTextResponse("Another request is being profiled", 409)
+            await response(scope, receive, send)
+            return
+
+        if self.directory is not None:
+            await self.save(scope, receive, send)
+        else:
+            await self.reply(scope, receive, send)
+
+    @contextmanager
+    def profile(self) -> Iterator[cProfile.Profile]:
+        # Everything else the worker runs meanwhile shows up too
+        profiler = cProfile.Profile()
+        self._busy = True
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            self._busy = False
+
+    async def save(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        name = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.prof"
+        path = os.path.join(self.directory, name)
+
+        async def started(message: Dict) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile", name.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        with self.profile() as profiler:
+            await self.app(scope, receive, started)
+        profiler.dump_stats(path)
+
+    async def reply(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        status = [500]
+
+        async def discard(message: Dict) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+
+        with self.profile() as profiler:
+            await self.app(scope, receive, discard)
+
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats("cumulative").print_stats(PROFILE_LIMIT)
+
+        response = PlainTextResponse(
+            output.getvalue(), headers={"X-Profile-Status": str(status[0])}
+        )
+        await response(scope, receive, send)
+
+
+class SlowLog:
+    # Logs the statements of a sample of the requests slower than threshold
+    def __init__(
+        self, app: Callable, threshold: float, sample: float, dialect: Any
+    ) -> None:
+        self.app = app
+        self.threshold = threshold
+        self.sample = sample
+        self.dialect = dialect
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        if (
+            scope["type"] != "http"
+            or self.threshold <= 0
+            or random.random() >= self.sample
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        collected: List[Tuple[Any, float]] = []
+        token = statements.set(collected)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            elapsed = time.perf_counter() - start
+            statements.reset(token)
+
+            if elapsed >= self.threshold:
+                self.log(scope, elapsed, collected)
+
+    def log(self, scope: Dict, elapsed: float, collected: List) -> None:
+        lines = []
+        for statement, seconds in collected:
+            # Only compiled for the requests that are actually logged
+            compiled = statement.compile(dialect=self.dialect)
+            lines.append(f"{seconds:.3f}s {compiled} {compiled.params}")
+
+        query = scope.get("query_string", b"").decode("latin-1")
+        logger.warning(
+            "Slow request %s %s?%s took %.3fs\n%s",
+            scope["method"],
+            scope["path"],
+            query,
+            elapsed,
+            "\n".join(lines),
+        )
@@ -0,0 +1,148 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from .functions import as_utc, bounds, haversine
+
+
+class Recent:
+    def __init__(self, span: float, stats: List[str], identity: List[str]) -> None:
+        self.span = span
+        self.fields = stats
+        self.identity = identity
+        self.ready = False
+        # Everything recorded since then is kept
+        self.since = self.cutoff()
+        # Sorted by recorded, with the timestamps kept apart for bisect
+        self._keys: List[datetime] = []
+        self._rows: List[SimpleNamespace] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.span > 0
+
+    def cutoff(self) -> datetime:
+        return datetime.now(timezone.utc) - timedelta(seconds=self.span)
+
+    def expire(self) -> None:
+        self.since = self.cutoff()
+        index = bisect.bisect_left(self._keys, self.since)
+        del self._keys[:index]
+        del self._rows[:index]
+
+    def warm(self, rows: List[Dict[str, Any]]) -> None:
+        self._keys = []
+        self._rows = []
+        self.ready = True
+        self.since = self.cutoff()
+        self.add(rows)
+
+    def add(self, rows: List[Dict[str, Any]]) -> None:
+        if not self.ready:
+            return
+
+        for row in rows:
+            record = SimpleNamespace(**row)
+            record.recorded = as_utc(record.recorded)
+
+            if record.recorded < self.since:
+                continue
+
+            # Measurements mostly arrive in order, so this is usually an append
+            if not self._keys or record.recorded >= self._keys[-1]:
+                self._keys.append(record.recorded)
+                self._rows.append(record)
+            else:
+                index = bisect.bisect_right(self._keys, record.recorded)
+                self._keys.insert(index, record.recorded)
+                self._rows.insert(index, record)
+
+        self.expire()
+
+    def covers(self, query: Any) -> bool:
+        if not self.enabled or not self.ready:
+            return False
+        if getattr(query, "limit", None) is not None:
+            return False
+        if getattr(query, "cursor", None) is not None:
+            return False
+
+        return query.start is not None and as_utc(query.start) >= self.since
+
+    def select(self, query: Any) -> List[SimpleNamespace]:
+        start = bisect.bisect_left(self._keys, as_utc(query.start))
+        end = len(self._keys)
+        if query.end is not None:
+            end = bisect.bisect_right(self._keys, as_utc(query.end))
+
+        rows = self._rows[start:end]
+
+        if query.source is not None:
+            rows = [r for r in rows if r.source == query.source]
+        if query.distance is not None:
+            longitude = query.longitude if query.longitude is not None else 0.0
+            latitude = query.latitude if query.latitude is not None else 0.0
+            north, east, south, west = bounds(latitude, longitude, query.distance)
+            rows = [
+                r
+                for r in rows
+                if south <= r.latitude <= north and west <= r.longitude <= east
+            ]
+            if rows:
+                distances = haversine(
+                    latitude,
+                    longitude,
+                    [r.latitude for r in rows],
+                    [r.longitude for r in rows],
+                )
+                rows = [
+                    r for r, d in zip(rows, distances.tolist()) if d <= query.distance
+                ]
+
+        # Same order the database is asked for, NULL descriptions last
+        return sorted(rows, key=lambda r: (r.description is None, r.description or ""))
+
+    def stats(self, query: Any) -> List[SimpleNamespace]:
+        groups: Dict[tuple, List[SimpleNamespace]] = {}
+
+        # By device, where missing and empty descriptions are the same
+        for row in self.select(query):
+            key = tuple(
+                getattr(row, c) or "" if c == "description" else getattr(row, c)
+                for c in self.identity
+            )
+            groups.setdefault(key, []).append(row)
+
+        results = []
+        for rows in groups.values():
+            result = SimpleNamespace(**{c: getattr(rows[0], c) for c in self.identity})
+
+            for stat in self.fields:
+                values = [getattr(r, stat) for r in rows]
+                values = [v for v in values if v is not None]
+                average = sum(values) / len(values) if values else None
+
+                setattr(result, f"{stat}_average", average)
+                setattr(result, f"{stat}_maximum", max(values, default=None))
+                setattr(result, f"{stat}_minimum", min(values, default=None))
+
+            results.append(result)
+
+        return results
@@ -13,8 +13,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import dataclasses
+import functools
+import numpy as np
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
 from . import schemas
-from .models import Measurement
+from .cache import MISSING, Cache, Flights
+from .functions import as_float, as_utc, ceil, floor
+from .models import IDENTITY, STATS, Measurement, locations
 
 
 CONCENTRATIONS = [
@@ -47,98 +57,319 @@ CATEGORIES = [
     schemas.Category.HAZARDOUS,
 ]
 
+PM10_CONCENTRATIONS = [
+    [0, 54],
+    [55, 154],
+    [155, 254],
+    [255, 354],
+    [355, 424],
+    [425, 504],
+    [505, 604],
+]
+
+# Concentration brackets of each pollutant, all of them share the breakpoints
+POLLUTANTS = {
+    schemas.Pollutant.PM2DOT5: np.array(CONCENTRATIONS, dtype=np.float64),
+    schemas.Pollutant.PM10: np.array(PM10_CONCENTRATIONS, dtype=np.float64),
+}
+BREAKPOINTS_TABLE = np.array(BREAKPOINTS, dtype=np.float64)
+
+# Widens the search around the nearest sensors, so none is missed by rounding
+NEAREST_MARGIN = 1.01
+
+NOWCAST_HOURS = 12
+NOWCAST_MINIMUM_WEIGHT = 0.5
+
+# Per worker, other workers only see new measurements once their entries expire
+reports_cache = Cache(
+    size=int(os.environ.get("LINKA_REPORTS_CACHE_SIZE", 256)),
+    ttl=float(os.environ.get("LINKA_REPORTS_CACHE_TTL", 30)),
+)
+reports_flights = Flights()
+REPORTS_CACHE_BUCKET = int(os.environ.get("LINKA_REPORTS_CACHE_BUCKET", 60))
+
+
+def normalize(query):
+    start = query.start
+    end = query.end
+
+    # Widen the window to whole buckets, so nearby requests share an entry
+    if REPORTS_CACHE_BUCKET > 0:
+        start = floor(start, REPORTS_CACHE_BUCKET) if start else None
+        end = ceil(end, REPORTS_CACHE_BUCKET) if end else None
+    else:
+        start = as_utc(start) if start else None
+        end = as_utc(end) if end else None
+
+    return dataclasses.replace(query, start=start, end=end, limit=None, cursor=None)
+
+
+def served(query):
+    # The query a report is actually generated for
+    return normalize(query) if reports_cache.enabled else query
+
+
+def cached(name):
+    def decorator(generate):
+        @functools.wraps(generate)
+        async def wrapper(db, query, ingested=None):
+            if not reports_cache.enabled:
+                return await generate(db, query)
+
+            query = normalize(query)
+            # Source and window first, so invalidate() can find them. Keyed by
+            # when its measurements last changed too, when known, so reports
+            # from before another worker stored new ones are left behind.
+            key = (name, query.source, query.start, query.end)
+            key += dataclasses.astuple(query) + (ingested,)
+
+            value = reports_cache.get(key)
+            if value is not MISSING:
+                return value
+
+            generation = reports_cache.generation
+
+            async def fetch():
+                value = await generate(db, query)
+                # Don't keep results that could predate an invalidation
+                if reports_cache.generation == generation:
+                    reports_cache.set(key, value)
+                return value
+
+            return await reports_flights.run(key, fetch)
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate(rows):
+    if not rows:
+        return
+
+    sources = {r["source"] for r in rows}
+    earliest = as_utc(min(r["recorded"] for r in rows))
+    latest = as_utc(max(r["recorded"] for r in rows))
+
+    def affected(key):
+        _, source, start, end = key[:4]
+        return (
+            (source is None or source in sources)
+            and (start is None or start <= latest)
+            and (end is None or end >= earliest)
+        )
+
+    reports_cache.discard(affected)
+
 
 class AQI:
     @staticmethod
-    def get_quality(source):
-        report = schemas.Report(
-            sensor=source.sensor,
-            source=source.source,
-            description=source.description,
-            latitude=source.latitude,
-            longitude=source.longitude,
-            quality=None,
-        )
+    def get_indexes(averages, pollutant=schemas.Pollutant.PM2DOT5):
+        averages = np.asarray(averages, dtype=np.float64)
+        concentrations = POLLUTANTS[pollutant]
+        last = len(concentrations) - 1
 
-        if source.pm2dot5_average is None:
-            return report
+        # First bracket whose upper bound isn't below the average, capped at
+        # the last bracket, same for the index and its category afterwards
+        brackets = np.searchsorted(concentrations[:, 1], averages, side="left")
+        brackets = np.minimum(brackets, last)
 
-        concentration = next(
-            (c for c in CONCENTRATIONS if source.pm2dot5_average <= c[1]),
-            CONCENTRATIONS[-1],
-        )
+        concentration = concentrations[brackets]
+        breakpoint = BREAKPOINTS_TABLE[brackets]
 
-        breakpoint_index = CONCENTRATIONS.index(concentration)
-        breakpoint = BREAKPOINTS[breakpoint_index]
+        indexes = (
+            (breakpoint[:, 1] - breakpoint[:, 0])
+            / (concentration[:, 1] - concentration[:, 0])
+        ) * (averages - concentration[:, 0]) + breakpoint[:, 0]
 
-        index = (
-            (breakpoint[1] - breakpoint[0]) / (concentration[1] - concentration[0])
-        ) * (source.pm2dot5_average - concentration[0]) + breakpoint[0]
-        index_breakpoint = next(
-            (b for b in BREAKPOINTS if index <= b[1]),
-            BREAKPOINTS[-1],
-        )
+        categories = np.searchsorted(BREAKPOINTS_TABLE[:, 1], indexes, side="left")
+        categories = np.minimum(categories, last)
+
+        return indexes, categories
+
+    @staticmethod
+    def get_qualities(concentrations):
+        # Concentrations per pollutant for every source, NaN when unknown
+        pollutants = list(concentrations)
+        results = [AQI.get_indexes(concentrations[p], p) for p in pollutants]
+        indexes = np.stack([i for i, _ in results])
+        categories = np.stack([c for _, c in results])
 
-        category_index = BREAKPOINTS.index(index_breakpoint)
-        category = CATEGORIES[category_index]
+        known = ~np.isnan(indexes)
+        dominant = np.argmax(np.where(known, indexes, -np.inf), axis=0)
+        columns = np.arange(indexes.shape[1])
 
-        report.quality = schemas.Quality(index=index, category=category)
+        qualities = []
+        for column, pollutant, index, category, measured in zip(
+            columns.tolist(),
+            dominant.tolist(),
+            indexes[dominant, columns].tolist(),
+            categories[dominant, columns].tolist(),
+            known.any(axis=0).tolist(),
+        ):
+            if not measured:
+                qualities.append(None)
+                continue
 
-        return report
+            # Already valid, so skip validating it again
+            qualities.append(
+                schemas.Quality.construct(
+                    category=CATEGORIES[category],
+                    index=int(index),
+                    pollutant=pollutants[pollutant],
+                )
+            )
+
+        return qualities
 
     @staticmethod
-    async def generate(db, query):
+    def get_nowcast(hours):
+        # Hourly averages for every source, the most recent hour first
+        known = ~np.isnan(hours)
+        highest = np.where(known, hours, -np.inf).max(axis=1)
+        lowest = np.where(known, hours, np.inf).min(axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(highest > 0, lowest / highest, 1.0)
+            weight = np.maximum(ratio, NOWCAST_MINIMUM_WEIGHT)
+            weights = weight[:, None] ** np.arange(hours.shape[1])
+            weights = np.where(known, weights, 0.0)
+
+            nowcast = (weights * np.where(known, hours, 0.0)).sum(axis=1)
+            nowcast = nowcast / weights.sum(axis=1)
+
+        # Needs two of the three most recent hours
+        enough = known[:, :3].sum(axis=1) >= 2
+        return np.where(enough, nowcast, np.nan)
+
+    @staticmethod
+    def get_report(source, quality=None):
+        # Shaped like schemas.Report, in the same order
+        return {
+            "sensor": source.sensor,
+            "source": source.source,
+            "description": source.description,
+            "longitude": as_float(source.longitude),
+            "latitude": as_float(source.latitude),
+            "quality": quality,
+        }
+
+    @staticmethod
+    async def average(db, query):
         sources = await Measurement.stats(db, query)
-        return [AQI.get_quality(s) for s in sources]
+        concentrations = {
+            p: np.array(
+                [getattr(s, f"{p.value}_average") for s in sources], dtype=np.float64
+            )
+            for p in POLLUTANTS
+        }
+
+        return sources, concentrations
+
+    @staticmethod
+    async def nowcast(db, query):
+        stats = [p.value for p in POLLUTANTS]
+        rows = await Measurement.hourly(db, query, NOWCAST_HOURS, stats)
+        end = floor(query.end or datetime.now(timezone.utc), 3600)
+
+        sources = {}
+        for row in rows:
+            sources.setdefault(tuple(row[c] for c in IDENTITY), row)
+
+        hours = {p: np.full((len(sources), NOWCAST_HOURS), np.nan) for p in POLLUTANTS}
+        positions = {identity: i for i, identity in enumerate(sources)}
+        for row in rows:
+            position = positions[tuple(row[c] for c in IDENTITY)]
+            hour = int((end - as_utc(row["bucket"])).total_seconds() // 3600)
+            for pollutant in POLLUTANTS:
+                value = row[f"{pollutant.value}_average"]
+                hours[pollutant][position, hour] = np.nan if value is None else value
+
+        concentrations = {p: AQI.get_nowcast(h) for p, h in hours.items()}
+        return list(sources.values()), concentrations
+
+    @staticmethod
+    @cached("aqi")
+    async def generate(db, query):
+        method = getattr(query, "method", schemas.Method.AVERAGE)
+        sources, concentrations = await METHODS[method](db, query)
+        qualities = AQI.get_qualities(concentrations)
+
+        return [AQI.get_report(s, q) for s, q in zip(sources, qualities)]
+
+    @staticmethod
+    async def nearest(db, query):
+        sensors = locations.nearest(query.latitude, query.longitude, query.n)
+        if not sensors:
+            return []
+
+        # Reports for everything within reach of the farthest one
+        around = schemas.AQIParams(
+            start=None,
+            latitude=query.latitude,
+            longitude=query.longitude,
+            distance=sensors[-1][1] * NEAREST_MARGIN + 0.001,
+        )
+        reports = {
+            tuple(r[c] for c in IDENTITY): r for r in await AQI.generate(db, around)
+        }
+
+        # Sensors without recent measurements are reported without quality
+        return [
+            reports.get(tuple(s[c] for c in IDENTITY))
+            or AQI.get_report(SimpleNamespace(**s))
+            for s, _ in sensors
+        ]
+
+
+METHODS = {
+    schemas.Method.AVERAGE: AQI.average,
+    schemas.Method.NOWCAST: AQI.nowcast,
+}
 
 
 class Stats:
     @staticmethod
     def get_stat(source):
-        return schemas.ReportStats(
-            sensor=source.sensor,
-            source=source.source,
-            description=source.description,
-            latitude=source.latitude,
-            longitude=source.longitude,
-            pm1dot0=schemas.BasicStats(
-                average=source.pm1dot0_average,
-                maximum=source.pm1dot0_maximum,
-                minimum=source.pm1dot0_minimum,
-            ),
-            pm2dot5=schemas.BasicStats(
-                average=source.pm2dot5_average,
-                maximum=source.pm2dot5_maximum,
-                minimum=source.pm2dot5_minimum,
-            ),
-            pm10=schemas.BasicStats(
-                average=source.pm10_average,
-                maximum=source.pm10_maximum,
-                minimum=source.pm10_minimum,
-            ),
-            humidity=schemas.BasicStats(
-                average=source.humidity_average,
-                maximum=source.humidity_maximum,
-                minimum=source.humidity_minimum,
-            ),
-            temperature=schemas.BasicStats(
-                average=source.temperature_average,
-                maximum=source.temperature_maximum,
-                minimum=source.temperature_minimum,
-            ),
-            pressure=schemas.BasicStats(
-                average=source.pressure_average,
-                maximum=source.pressure_maximum,
-                minimum=source.pressure_minimum,
-            ),
-            co2=schemas.BasicStats(
-                average=source.co2_average,
-                maximum=source.co2_maximum,
-                minimum=source.co2_minimum,
-            ),
-        )
+        # Shaped like schemas.ReportStats, in the same order
+        stat = {
+            "sensor": source.sensor,
+            "source": source.source,
+            "description": source.description,
+            "longitude": as_float(source.longitude),
+            "latitude": as_float(source.latitude),
+        }
+        for field in STATS:
+            stat[field] = {
+                "average": as_float(getattr(source, f"{field}_average")),
+                "maximum": as_float(getattr(source, f"{field}_maximum")),
+                "minimum": as_float(getattr(source, f"{field}_minimum")),
+            }
+
+        return stat
 
     @staticmethod
+    @cached("stats")
     async def generate(db, query):
         sources = await Measurement.stats(db, query)
         return [Stats.get_stat(s) for s in sources]
+
+
+class Series:
+    @staticmethod
+    def get_series(bucket, fields):
+        stats = {
+            field: schemas.BasicStats(
+                average=getattr(bucket, f"{field}_average"),
+                maximum=getattr(bucket, f"{field}_maximum"),
+                minimum=getattr(bucket, f"{field}_minimum"),
+            )
+            for field in fields
+        }
+        return schemas.Series(recorded=bucket.recorded, **stats)
+
+    @staticmethod
+    async def generate(db, query):
+        fields = query.fields.split(",")
+        buckets = await Measurement.series(db, query)
+        return [Series.get_series(b, fields) for b in buckets]
@@ -0,0 +1,140 @@
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import orjson
+import functools
+
+from datetime import datetime
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Optional, Type
+
+from .functions import as_float, as_utc
+
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+CHUNK_SIZE = 1000
+
+# Encodes rows straight from the records, without the response models
+ORJSON = bool(int(os.environ.get("LINKA_ORJSON", 0)))
+
+
+async def iterate(records: Iterable[Any]) -> AsyncIterator[Any]:
+    for record in records:
+        yield record
+
+
+def identity(value: Any) -> Any:
+    return value
+
+
+def as_utc_or_none(value: Optional[datetime]) -> Optional[datetime]:
+    return None if value is None else as_utc(value)
+
+
+@functools.lru_cache(maxsize=None)
+def compile(model: Type[BaseModel]) -> Callable[[Any], Dict[str, Any]]:
+    # Converts the fields of flat models like pydantic does, datetimes to UTC
+    # like Measurement.must_be_utc does
+    converters = []
+    for name, field in model.__fields__.items():
+        if issubclass(field.type_, float):
+            converters.append((name, as_float))
+        elif issubclass(field.type_, datetime):
+            converters.append((name, as_utc_or_none))
+        else:
+            converters.append((name, identity))
+
+    def row(record: Any) -> Dict[str, Any]:
+        return {name: convert(getattr(record, name)) for name, convert in converters}
+
+    return row
+
+
+def encode(record: Any, model: Type[BaseModel]) -> bytes:
+    if ORJSON:
+        return orjson.dumps(compile(model)(record))
+
+    # Same settings as JSONResponse, so streamed rows look exactly the same
+    return json.dumps(
+        jsonable_encoder(model.from_orm(record)),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return dict(value)
+    raise TypeError
+
+
+def render(content: Any) -> Any:
+    # Rows already shaped like the response model can skip its validation
+    if not ORJSON:
+        return content
+
+    return Response(orjson.dumps(content, default=default), media_type=JSON)
+
+
+async def encode_json(
+    records: AsyncIterator[Any], model: Type[BaseModel]
+) -> AsyncIterator[bytes]:
+    chunk = [b"["]
+    separator = b""
+
+    async for record in records:
+        chunk.append(separator)
+        chunk.append(encode(record, model))
+        separator = b","
+
+        if len(chunk) >= CHUNK_SIZE * 2:
+            yield b"".join(chunk)
+            chunk = []
+
+    chunk.append(b"]")
+    yield b"".join(chunk)
+
+
+async def encode_ndjson(
+    records: AsyncIterator[Any], model: Type[BaseModel]
+) -> AsyncIterator[bytes]:
+    chunk = []
+
+    async for record in records:
+        chunk.append(encode(record, model))
+        chunk.append(b"\n")
+
+        if len(chunk) >= CHUNK_SIZE * 2:
+            yield b"".join(chunk)
+            chunk = []
+
+    if chunk:
+        yield b"".join(chunk)
+
+
+def stream(
+    records: AsyncIterator[Any], model: Type[BaseModel], accept: Optional[str]
+) -> StreamingResponse:
+    if accept is not None and NDJSON in accept:
+        return StreamingResponse(encode_ndjson(records, model), media_type=NDJSON)
+
+    return StreamingResponse(encode_json(records, model), media_type=JSON)
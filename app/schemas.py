@@ -13,12 +13,36 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import binascii
+
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 from pydantic import BaseModel, Field, validator
 from pydantic.dataclasses import dataclass
-from typing import Optional, Union
-from fastapi import Query
+from typing import Optional, Tuple, Union
+from fastapi import HTTPException, Query, status
+
+
+# Queries without a start cover this much time before now
+DEFAULT_WINDOW = timedelta(minutes=5)
+
+
+def encode_cursor(recorded: datetime, id: int) -> str:
+    value = f"{recorded.isoformat()}|{id}"
+    return base64.urlsafe_b64encode(value.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        recorded, id = value.split("|")
+        recorded, id = datetime.fromisoformat(recorded), int(id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+    recorded = recorded if recorded.tzinfo else recorded.replace(tzinfo=timezone.utc)
+    return recorded, id
 
 
 class Measurement(BaseModel):
@@ -127,6 +151,26 @@ class Measurement(BaseModel):
         orm_mode = True
 
 
+# Measurements are posted as a plain body, decoded by formats and validated
+# by ingest, so their schema is documented as it would be for List[Measurement]
+MEASUREMENTS_SCHEMA = {
+    "title": "Measurements",
+    "type": "array",
+    "items": {"$ref": "#/components/schemas/Measurement"},
+}
+MEASUREMENTS_BODY = {
+    "requestBody": {
+        "content": {
+            "application/json": {"schema": MEASUREMENTS_SCHEMA},
+            "application/msgpack": {"schema": MEASUREMENTS_SCHEMA},
+            "application/cbor": {"schema": MEASUREMENTS_SCHEMA},
+            "text/csv": {"schema": {"type": "string"}},
+        },
+        "required": True,
+    }
+}
+
+
 @dataclass
 class QueryParams:
     source: str = Query(
@@ -159,13 +203,140 @@ class QueryParams:
         title="Distance",
         description="Include measurements that are this kilometers far from the target",
     )
+    limit: int = Query(
+        None,
+        title="Limit",
+        description="Include up to this number of measurements, sorted by date and time",
+        ge=1,
+    )
+    cursor: str = Query(
+        None,
+        title="Cursor",
+        description="Include measurements after this cursor, from the X-Next-Cursor header",
+    )
 
     @validator("start")
     def only_recent(cls, v):
-        v = v if v else datetime.now(timezone.utc) - timedelta(minutes=5)
+        v = v if v else datetime.now(timezone.utc) - DEFAULT_WINDOW
+        return v
+
+    @validator("cursor")
+    def valid_cursor(cls, v):
+        if v is None:
+            return v
+
+        # Errors from dependencies aren't turned into responses, so do it here
+        try:
+            decode_cursor(v)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+            )
+
         return v
 
 
+class Method(str, Enum):
+    AVERAGE = "average"
+    NOWCAST = "nowcast"
+
+
+@dataclass
+class AQIParams(QueryParams):
+    method: Method = Query(
+        Method.AVERAGE,
+        title="Method",
+        description="Average over the window, or NowCast over the 12 hours before the end",
+    )
+
+
+@dataclass
+class NearestParams:
+    latitude: float = Query(
+        ...,
+        title="Latitude",
+        description="Target latitude coordinate",
+        ge=-90,
+        le=90,
+    )
+    longitude: float = Query(
+        ...,
+        title="Longitude",
+        description="Target longitude coordinate",
+        ge=-180,
+        le=180,
+    )
+    n: int = Query(
+        5,
+        title="N",
+        description="Include this number of sensors, the closest ones to the target",
+        ge=1,
+        le=100,
+    )
+
+
+class Bucket(str, Enum):
+    MINUTE = "1m"
+    FIVE_MINUTES = "5m"
+    FIFTEEN_MINUTES = "15m"
+    HOUR = "1h"
+    DAY = "1d"
+
+    @property
+    def seconds(self):
+        units = {"m": 60, "h": 3600, "d": 86400}
+        return int(self.value[:-1]) * units[self.value[-1]]
+
+
+@dataclass
+class SeriesParams:
+    source: str = Query(
+        ...,
+        title="Source",
+        description="Include measurements from this source only",
+    )
+    start: datetime = Query(
+        None,
+        title="Start",
+        description="Include measurements after this date and time",
+    )
+    end: datetime = Query(
+        None,
+        title="End",
+        description="Include measurements before this date and time",
+    )
+    bucket: Bucket = Query(
+        Bucket.HOUR,
+        title="Bucket",
+        description="Summarize measurements over periods of this length",
+    )
+    fields: str = Query(
+        "pm2dot5",
+        title="Fields",
+        description="Comma separated list of measurements to summarize",
+    )
+
+    @validator("start")
+    def only_last_day(cls, v):
+        v = v if v else datetime.now(timezone.utc) - timedelta(days=1)
+        return v
+
+    @validator("fields")
+    def valid_fields(cls, v):
+        fields = v.split(",")
+        valid = [f for f in Series.__fields__ if f != "recorded"]
+
+        # Errors from dependencies aren't turned into responses, so do it here
+        if not fields or not set(fields).issubset(valid):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Fields must be a comma separated list of {', '.join(valid)}",
+            )
+
+        # Each field is aggregated once, so repeating one would clash
+        return ",".join(dict.fromkeys(fields))
+
+
 class Provider(BaseModel):
     provider: str = Field(
         ...,
@@ -194,6 +365,11 @@ class Category(str, Enum):
     HAZARDOUS = "Hazardous"
 
 
+class Pollutant(str, Enum):
+    PM2DOT5 = "pm2dot5"
+    PM10 = "pm10"
+
+
 class Quality(BaseModel):
     category: Category = Field(
         ...,
@@ -205,6 +381,11 @@ class Quality(BaseModel):
         title="Index",
         description="Index of the air quality",
     )
+    pollutant: Pollutant = Field(
+        None,
+        title="Pollutant",
+        description="Pollutant with the highest index",
+    )
 
 
 class Report(BaseModel):
@@ -291,6 +472,39 @@ class ReportStats(BaseModel):
     co2: BasicStats = Field(..., title="CO2", description="Basic stats from CO2")
 
 
+class Series(BaseModel):
+    recorded: datetime = Field(
+        ...,
+        title="Recorded",
+        description="Date and time for when this period started",
+    )
+    pm1dot0: Optional[BasicStats] = Field(
+        None, title="pm1dot0", description="Basic stats from pm1dot0"
+    )
+    pm2dot5: Optional[BasicStats] = Field(
+        None, title="pm2dot5", description="Basic stats from pm2dot5"
+    )
+    pm10: Optional[BasicStats] = Field(
+        None, title="pm10", description="Basic stats from pm10"
+    )
+    humidity: Optional[BasicStats] = Field(
+        None, title="humidity", description="Basic stats from humidity"
+    )
+    temperature: Optional[BasicStats] = Field(
+        None, title="temperature", description="Basic stats from temperature"
+    )
+    pressure: Optional[BasicStats] = Field(
+        None, title="pressure", description="Basic stats from pressure"
+    )
+    co2: Optional[BasicStats] = Field(
+        None, title="CO2", description="Basic stats from CO2"
+    )
+
+    @validator("recorded")
+    def must_be_utc(cls, v):
+        return v if v.tzinfo else v.replace(tzinfo=timezone.utc)
+
+
 class Status(str, Enum):
     UP = "UP"
     DOWN = "DOWN"
@@ -13,15 +13,28 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from fastapi import FastAPI, Depends
+import os
+import databases
+import sqlalchemy
+
+from fastapi import FastAPI, Depends, Header, HTTPException, Request, Response
+from fastapi import status as codes
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security.api_key import APIKey
-from typing import List
+from typing import List, Optional
 
 from . import models
+from . import formats
 from . import schemas
 from . import reports
+from . import metrics
+from . import compression
+from . import conditional
+from . import profiling
+from . import responses
 from .db import db
+from .ingest import Buffer, validate_measurements
+from .periodic import Periodic
 from .authentication import validate_api_key, validate_master_key
 
 
@@ -32,16 +45,171 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
     allow_credentials=True,
+    expose_headers=["X-Next-Cursor", "ETag"],
+)
+app.add_middleware(
+    compression.Compress,
+    encodings=os.environ.get("LINKA_COMPRESSION", "zstd,br,gzip").split(","),
+    minimum=int(os.environ.get("LINKA_COMPRESSION_MINIMUM_SIZE", 1024)),
+    levels={
+        "zstd": int(os.environ.get("LINKA_COMPRESSION_ZSTD_LEVEL", 3)),
+        "br": int(os.environ.get("LINKA_COMPRESSION_BROTLI_LEVEL", 4)),
+        "gzip": int(os.environ.get("LINKA_COMPRESSION_GZIP_LEVEL", 6)),
+    },
+)
+app.add_middleware(metrics.Instrument)
+app.add_middleware(
+    profiling.SlowLog,
+    threshold=float(os.environ.get("LINKA_SLOW_REQUEST_SECONDS", 0)),
+    sample=float(os.environ.get("LINKA_SLOW_REQUEST_SAMPLE", 1.0)),
+    dialect=sqlalchemy.engine.make_url(str(db.url)).get_dialect()(),
+)
+app.add_middleware(
+    profiling.Profiler,
+    enabled=bool(int(os.environ.get("LINKA_PROFILING", 0))),
+    directory=os.environ.get("LINKA_PROFILING_DIRECTORY"),
+)
+
+
+async def store(rows):
+    await models.Measurement.store(db, rows)
+    models.recent.add(rows)
+    models.locations.add(rows)
+    reports.invalidate(rows)
+    metrics.ingested.inc(len(rows))
+    metrics.batches.observe(len(rows))
+
+
+buffer = Buffer(
+    store=store,
+    size=int(os.environ.get("LINKA_INGEST_BUFFER_SIZE", 0)),
+    batch=int(os.environ.get("LINKA_INGEST_BATCH_SIZE", 5000)),
+    interval=float(os.environ.get("LINKA_INGEST_FLUSH_INTERVAL", 1.0)),
+    retries=int(os.environ.get("LINKA_INGEST_RETRIES", 3)),
+)
+BufferFull = HTTPException(
+    status_code=codes.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many measurements pending, try again later",
+    headers={"Retry-After": "1"},
+)
+# Retrying wouldn't help, these never fit into the queue
+BatchTooLarge = HTTPException(
+    status_code=codes.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    detail="More measurements than LINKA_INGEST_BUFFER_SIZE, send smaller batches",
+)
+
+retention = Periodic(
+    run=lambda: models.Retention.compact(db),
+    interval=float(os.environ.get("LINKA_RETENTION_INTERVAL", 0)),
+)
+
+locator = Periodic(
+    run=lambda: models.Measurement.relocate(db),
+    interval=float(os.environ.get("LINKA_LOCATIONS_INTERVAL", 0)),
+)
+
+caches = {
+    "auth": models.keys_cache,
+    "devices": models.devices_cache,
+    "reports": reports.reports_cache,
+}
+metrics.registry.register(
+    metrics.Callback(
+        "linka_cache_hits_total",
+        "Lookups answered by a cache",
+        "counter",
+        lambda: {(("cache", n),): c.hits for n, c in caches.items()},
+    )
+)
+metrics.registry.register(
+    metrics.Callback(
+        "linka_cache_misses_total",
+        "Lookups a cache could not answer",
+        "counter",
+        lambda: {(("cache", n),): c.misses for n, c in caches.items()},
+    )
+)
+
+metrics.registry.register(
+    metrics.Callback(
+        "linka_dropped_measurements_total",
+        "Buffered measurements that could not be stored",
+        "counter",
+        lambda: {(): buffer.dropped},
+    )
+)
+
+
+# The pool is only reachable through databases internals, which can change
+# with any release, so it's left out on versions it wasn't checked against
+POOL_VERSIONS = ("0.7.",)
+
+
+def pool():
+    # Only asyncpg keeps a pool of connections to report on
+    if not databases.__version__.startswith(POOL_VERSIONS):
+        return None
+
+    pool_ = getattr(getattr(db, "_backend", None), "_pool", None)
+    return pool_ if hasattr(pool_, "get_idle_size") else None
+
+
+def connections():
+    if pool() is None:
+        return {}
+
+    idle = pool().get_idle_size()
+    return {
+        (("state", "idle"),): idle,
+        (("state", "used"),): pool().get_size() - idle,
+    }
+
+
+def connections_max():
+    return {(): pool().get_max_size()} if pool() is not None else {}
+
+
+metrics.registry.register(
+    metrics.Callback(
+        "linka_database_connections",
+        "Connections in the database pool",
+        "gauge",
+        connections,
+    )
+)
+metrics.registry.register(
+    metrics.Callback(
+        "linka_database_connections_max",
+        "Connections the database pool can open",
+        "gauge",
+        connections_max,
+    )
 )
 
 
 @app.on_event("startup")
 async def startup():
     await db.connect()
+    await models.Measurement.warm(db)
+    await models.Measurement.locate(db)
+
+    if buffer.enabled:
+        await buffer.start()
+    if retention.enabled:
+        await retention.start()
+    if locator.enabled:
+        await locator.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    if buffer.enabled:
+        await buffer.stop()
+    if retention.enabled:
+        await retention.stop()
+    if locator.enabled:
+        await locator.stop()
+
     await db.disconnect()
 
 
@@ -62,32 +230,110 @@ async def list_providers(key: APIKey = Depends(validate_master_key)):
 
 @app.delete("/api/v1/providers/{provider}")
 async def delete_provider(provider: str, key: APIKey = Depends(validate_master_key)):
-    return await models.Provider.revoke_all_keys(db, provider)
+    result = await models.Provider.revoke_all_keys(db, provider)
+    # Their measurements are gone too
+    reports.reports_cache.invalidate()
+    await models.Device.touch(db)
+    await models.Measurement.warm(db)
+    await models.Measurement.locate(db)
+    return result
 
 
-@app.post("/api/v1/measurements")
+@app.post("/api/v1/measurements", openapi_extra=schemas.MEASUREMENTS_BODY)
 async def post(
-    measurements: List[schemas.Measurement], provider: str = Depends(validate_api_key)
+    request: Request,
+    response: Response,
+    provider: str = Depends(validate_api_key),
 ):
-    await models.Measurement.store(db, [m.to_orm(provider) for m in measurements])
+    # Decoded by content type and validated by columns, see formats and ingest
+    measurements = await formats.decode(request)
+    rows = validate_measurements(measurements, provider)
 
+    if not buffer.enabled:
+        await store(rows)
+        return
 
-@app.get("/api/v1/measurements", response_model=List[schemas.Measurement])
-async def get(query: schemas.QueryParams = Depends(schemas.QueryParams)):
-    return [
-        schemas.Measurement.from_orm(m)
-        for m in await models.Measurement.retrieve(db, query)
-    ]
+    if len(rows) > buffer.size:
+        raise BatchTooLarge
+    if not buffer.put(rows):
+        raise BufferFull
+
+    response.status_code = codes.HTTP_202_ACCEPTED
+
+
+@app.get(
+    "/api/v1/measurements",
+    response_model=List[schemas.Measurement],
+    responses={200: {"content": {responses.NDJSON: {}}}},
+)
+async def get(
+    request: Request,
+    query: schemas.QueryParams = Depends(schemas.QueryParams),
+    accept: Optional[str] = Header(None),
+):
+    ingested = await models.Measurement.ingested(db, query)
+    headers = conditional.check(request, query, ingested)
+
+    if query.limit is None:
+        response = responses.stream(
+            models.Measurement.iterate(db, query), schemas.Measurement, accept
+        )
+        response.headers.update(headers)
+        return response
+
+    records, cursor = await models.Measurement.page(db, query)
+    response = responses.stream(responses.iterate(records), schemas.Measurement, accept)
+    response.headers.update(headers)
+    if cursor is not None:
+        response.headers["X-Next-Cursor"] = cursor
+
+    return response
 
 
 @app.get("/api/v1/aqi", response_model=List[schemas.Report])
-async def aqi(query: schemas.QueryParams = Depends(schemas.QueryParams)):
-    return await reports.AQI.generate(db, query)
+async def aqi(
+    request: Request,
+    response: Response,
+    query: schemas.AQIParams = Depends(schemas.AQIParams),
+):
+    # Nothing is generated when the client has the latest report already
+    ingested = await models.Measurement.ingested(db, query)
+    headers = conditional.check(request, reports.served(query), ingested)
+
+    content = responses.render(await reports.AQI.generate(db, query, ingested))
+    return conditional.tag(content, response, headers)
+
+
+@app.get("/api/v1/aqi/nearest", response_model=List[schemas.Report])
+async def nearest(query: schemas.NearestParams = Depends(schemas.NearestParams)):
+    return responses.render(await reports.AQI.nearest(db, query))
 
 
 @app.get("/api/v1/stats", response_model=List[schemas.ReportStats])
-async def stats(query: schemas.QueryParams = Depends(schemas.QueryParams)):
-    return await reports.Stats.generate(db, query)
+async def stats(
+    request: Request,
+    response: Response,
+    query: schemas.QueryParams = Depends(schemas.QueryParams),
+):
+    ingested = await models.Measurement.ingested(db, query)
+    headers = conditional.check(request, reports.served(query), ingested)
+
+    content = responses.render(await reports.Stats.generate(db, query, ingested))
+    return conditional.tag(content, response, headers)
+
+
+@app.get(
+    "/api/v1/series",
+    response_model=List[schemas.Series],
+    response_model_exclude_unset=True,
+)
+async def series(query: schemas.SeriesParams = Depends(schemas.SeriesParams)):
+    return await reports.Series.generate(db, query)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(key: APIKey = Depends(validate_master_key)):
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
 
 
 @app.get("/api/v1/status", response_model=schemas.ServiceStatus)
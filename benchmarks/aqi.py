@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import random
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from app.reports import AQI, BREAKPOINTS, CONCENTRATIONS  # noqa: E402
+
+
+def scalar(average):
+    # The previous per source implementation, kept as the reference
+    concentration = next(
+        (c for c in CONCENTRATIONS if average <= c[1]),
+        CONCENTRATIONS[-1],
+    )
+
+    breakpoint = BREAKPOINTS[CONCENTRATIONS.index(concentration)]
+
+    index = (
+        (breakpoint[1] - breakpoint[0]) / (concentration[1] - concentration[0])
+    ) * (average - concentration[0]) + breakpoint[0]
+    index_breakpoint = next(
+        (b for b in BREAKPOINTS if index <= b[1]),
+        BREAKPOINTS[-1],
+    )
+
+    return index, BREAKPOINTS.index(index_breakpoint)
+
+
+def generate(sources):
+    # Random averages plus every bracket bound, right above it and past the end
+    bounds = [v for c in CONCENTRATIONS for v in c]
+    edges = bounds + [v + 0.05 for v in bounds] + [0.0, 600.0, 10000.0]
+    return edges + [random.uniform(0, 600) for _ in range(sources)]
+
+
+def measure(method, averages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        method(averages)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sources", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+
+    args = parser.parse_args()
+
+    print(f"{'sources':>8} {'scalar':>12} {'vectorised':>12} {'speedup':>8}")
+    for sources in args.sources:
+        averages = generate(sources)
+
+        expected = [scalar(a) for a in averages]
+        indexes, categories = AQI.get_indexes(averages)
+        if list(zip(indexes.tolist(), categories.tolist())) != expected:
+            sys.exit("vectorised results differ from the scalar ones")
+
+        before = measure(lambda a: [scalar(v) for v in a], averages, args.repeat)
+        after = measure(AQI.get_indexes, averages, args.repeat)
+
+        print(
+            f"{sources:>8} {before * 1000:>9.2f} ms {after * 1000:>9.2f} ms "
+            f"{before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import json
+import argparse
+
+
+def load(path):
+    with open(path) as file:
+        results = json.load(file)
+
+    return {size["days"]: size for size in results["sizes"]}, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=1.25)
+
+    args = parser.parse_args()
+
+    before, before_results = load(args.before)
+    after, after_results = load(args.after)
+    print(f"{before_results['commit']} -> {after_results['commit']}\n")
+
+    # Ratios above one are slower
+    regressions = []
+    print(f"{'days':>6} {'name':<18} {'before':>12} {'after':>12} {'ratio':>7}")
+    for days in sorted(set(before) & set(after)):
+        rows = [
+            (
+                "ingest",
+                1000 / before[days]["ingest"]["rows_per_second"],
+                1000 / after[days]["ingest"]["rows_per_second"],
+            )
+        ]
+        for name, result in after[days]["queries"].items():
+            if name in before[days]["queries"]:
+                previous = before[days]["queries"][name]["median_ms"]
+                rows.append((name, previous, result["median_ms"]))
+
+        for name, previous, current in rows:
+            ratio = current / previous
+            flag = " !" if ratio > args.threshold else ""
+            print(
+                f"{days:>6g} {name:<18} {previous:>9.2f} ms {current:>9.2f} ms "
+                f"{ratio:>6.2f}x{flag}"
+            )
+            if flag:
+                regressions.append((days, name))
+
+    if regressions:
+        sys.exit(f"\n{len(regressions)} regressions over {args.threshold}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+from typing import List
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+from app import responses, schemas  # noqa: E402
+from app.models import STATS  # noqa: E402
+from app.reports import AQI, Stats  # noqa: E402
+from fleet import fleet  # noqa: E402
+
+
+def records(rows, seed):
+    # Stats and AQI sources look like the records from Measurement.stats
+    rng = random.Random(seed)
+    measurements = []
+    sources = []
+
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(seconds=300 * (rows // 100 + 1))
+    for measurement in list(fleet(100, start, end, 300, seed))[:rows]:
+        measurement["recorded"] = datetime.fromisoformat(measurement["recorded"])
+        measurements.append(SimpleNamespace(**measurement))
+
+    for index in range(rows):
+        source = {
+            "sensor": "PMS5003",
+            "source": f"fleet-{index}",
+            "description": f"Sensor {index}" if index % 10 else None,
+            "latitude": rng.uniform(-26, -25),
+            "longitude": rng.uniform(-58, -57),
+        }
+        for field in STATS:
+            known = rng.random() > 0.1
+            for stat in ["average", "maximum", "minimum"]:
+                value = rng.uniform(0, 100) if known else None
+                source[f"{field}_{stat}"] = value
+        sources.append(SimpleNamespace(**source))
+
+    return measurements, sources
+
+
+def serialize(model, content):
+    # What FastAPI does with whatever a handler returns for its response_model
+    field = create_response_field(name=f"Response_{model.__name__}", type_=List[model])
+    encoded = asyncio.run(serialize_response(field=field, response_content=content))
+    return JSONResponse(encoded).body
+
+
+async def collect(records, model):
+    chunks = [c async for c in responses.encode_json(responses.iterate(records), model)]
+    return b"".join(chunks)
+
+
+def stream(records, model, orjson):
+    responses.ORJSON = orjson
+    try:
+        return asyncio.run(collect(records, model))
+    finally:
+        responses.ORJSON = True
+
+
+def reports(sources):
+    qualities = AQI.get_qualities(
+        {
+            schemas.Pollutant.PM2DOT5: [s.pm2dot5_average for s in sources],
+            schemas.Pollutant.PM10: [s.pm10_average for s in sources],
+        }
+    )
+    return [AQI.get_report(s, q) for s, q in zip(sources, qualities)]
+
+
+def measure(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+
+    args = parser.parse_args()
+    responses.ORJSON = True
+
+    print(f"{'response':>12} {'rows':>8} {'before':>12} {'after':>12} {'speedup':>8}")
+    for rows in args.rows:
+        measurements, sources = records(rows, args.seed)
+        stats = [Stats.get_stat(s) for s in sources]
+        aqi = reports(sources)
+
+        # Before, each row became a model validated again for the response
+        cases = {
+            "measurements": (
+                lambda: stream(measurements, schemas.Measurement, False),
+                lambda: stream(measurements, schemas.Measurement, True),
+            ),
+            "stats": (
+                lambda: serialize(
+                    schemas.ReportStats, [schemas.ReportStats(**s) for s in stats]
+                ),
+                lambda: responses.render(stats).body,
+            ),
+            "aqi": (
+                lambda: serialize(schemas.Report, [schemas.Report(**r) for r in aqi]),
+                lambda: responses.render(aqi).body,
+            ),
+        }
+
+        for name, (before, after) in cases.items():
+            if json.loads(before()) != json.loads(after()):
+                sys.exit(f"{name} responses differ")
+
+            before_ = measure(before, args.repeat)
+            after_ = measure(after, args.repeat)
+
+            print(
+                f"{name:>12} {rows:>8} {before_ * 1000:>9.2f} ms "
+                f"{after_ * 1000:>9.2f} ms {before_ / after_:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
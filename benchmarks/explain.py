@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import random
+import argparse
+import sqlalchemy
+
+from datetime import datetime, timezone, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from app import schemas  # noqa: E402
+from app.db import metadata  # noqa: E402
+from app.functions import geohash  # noqa: E402
+from app.models import Measurement, devices, measurements  # noqa: E402
+
+LATITUDE = -25.194156
+LONGITUDE = -57.521369
+
+
+def populate(connection, rows, sensors, days):
+    now = datetime.now(timezone.utc)
+    batch = []
+
+    for sensor in range(sensors):
+        latitude = LATITUDE + (sensor % 100) * 0.01
+        longitude = LONGITUDE + (sensor // 100) * 0.01
+        batch.append(
+            {
+                "id": sensor + 1,
+                "sensor": "bench",
+                "source": f"source-{sensor}",
+                "description": f"sensor {sensor}",
+                "latitude": latitude,
+                "longitude": longitude,
+                "geohash": geohash(latitude, longitude),
+            }
+        )
+    connection.execute(devices.insert(), batch)
+    batch = []
+
+    for index in range(rows):
+        batch.append(
+            {
+                "device_id": index % sensors + 1,
+                "pm2dot5": random.uniform(0, 150),
+                "recorded": now - timedelta(seconds=random.uniform(0, days * 86400)),
+            }
+        )
+
+        if len(batch) == 10000:
+            connection.execute(measurements.insert(), batch)
+            batch = []
+
+    if batch:
+        connection.execute(measurements.insert(), batch)
+
+
+def queries():
+    now = datetime.now(timezone.utc)
+    recent = now - timedelta(minutes=5)
+
+    return {
+        "recent": schemas.QueryParams(
+            source=None,
+            start=recent,
+            end=None,
+            latitude=None,
+            longitude=None,
+            distance=None,
+        ),
+        "source": schemas.QueryParams(
+            source="source-1",
+            start=now - timedelta(days=1),
+            end=now,
+            latitude=None,
+            longitude=None,
+            distance=None,
+        ),
+        "distance": schemas.QueryParams(
+            source=None,
+            start=recent,
+            end=None,
+            latitude=LATITUDE,
+            longitude=LONGITUDE,
+            distance=1.0,
+        ),
+    }
+
+
+def explain(connection, select):
+    compiled = select.compile(dialect=connection.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[key] for key in compiled.positiontup)
+
+    if connection.dialect.name == "postgresql":
+        statement = f"EXPLAIN ANALYZE {compiled}"
+    else:
+        statement = f"EXPLAIN QUERY PLAN {compiled}"
+
+    return [str(row[-1]) for row in connection.exec_driver_sql(statement, params)]
+
+
+def report(connection, label):
+    print(f"### {label}\n")
+
+    for name, query in queries().items():
+        select = Measurement.filter(measurements.select(), query)
+
+        start = time.perf_counter()
+        rows = len(connection.execute(select).fetchall())
+        elapsed = (time.perf_counter() - start) * 1000
+
+        print(f"{name}: {rows} rows in {elapsed:.2f} ms")
+        for line in explain(connection, select):
+            print(f"    {line}")
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", default="sqlite://")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--sensors", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=30)
+
+    args = parser.parse_args()
+    engine = sqlalchemy.create_engine(args.database_url)
+
+    if sqlalchemy.inspect(engine).has_table(measurements.name):
+        parser.error("measurements table already exists, use an empty database")
+
+    metadata.create_all(engine)
+
+    try:
+        with engine.begin() as connection:
+            for index in measurements.indexes | devices.indexes:
+                index.drop(connection)
+            populate(connection, args.rows, args.sensors, args.days)
+
+        with engine.begin() as connection:
+            report(connection, "Without indexes")
+
+            for index in measurements.indexes | devices.indexes:
+                index.create(connection)
+            connection.exec_driver_sql("ANALYZE")
+
+            report(connection, "With indexes")
+    finally:
+        metadata.drop_all(engine)
+
+
+if __name__ == "__main__":
+    main()
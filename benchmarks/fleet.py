@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import math
+import json
+import random
+import argparse
+
+from datetime import datetime, timezone, timedelta
+
+LATITUDE = -25.194156
+LONGITUDE = -57.521369
+# Sensors are spread over a city sized box around the center
+SPREAD = 0.15
+SENSORS = ["PMS5003", "SDS011", "HPMA115S0"]
+
+
+class Sensor:
+    def __init__(self, index, rng):
+        self.rng = rng
+        self.source = f"fleet-{index}"
+        self.sensor = SENSORS[index % len(SENSORS)]
+        self.description = f"Sensor {index}" if index % 10 else None
+        self.latitude = LATITUDE + rng.uniform(-SPREAD, SPREAD)
+        self.longitude = LONGITUDE + rng.uniform(-SPREAD, SPREAD)
+        self.baseline = rng.uniform(5, 60)
+        self.drift = 0.0
+        # Some sensors can't measure everything
+        self.co2 = index % 4 == 0
+        self.pm1dot0 = index % 3 != 0
+
+    def measure(self, recorded):
+        # Daily cycle peaking in the evening, plus a slow random walk
+        hour = recorded.hour + recorded.minute / 60
+        cycle = 1 + 0.4 * math.sin((hour - 13) / 24 * 2 * math.pi)
+        self.drift = max(-0.8, min(2.0, self.drift + self.rng.gauss(0, 0.02)))
+
+        pm2dot5 = self.baseline * cycle * (1 + self.drift) + self.rng.gauss(0, 2)
+        pm2dot5 = max(0.0, min(500.0, pm2dot5))
+
+        return {
+            "sensor": self.sensor,
+            "source": self.source,
+            "description": self.description,
+            "version": "1.0",
+            "pm1dot0": round(pm2dot5 * 0.7, 2) if self.pm1dot0 else None,
+            "pm2dot5": round(pm2dot5, 2),
+            "pm10": round(min(500.0, pm2dot5 * 1.4), 2),
+            "humidity": round(max(1.0, min(100.0, 60 + self.rng.gauss(0, 15))), 1),
+            "temperature": round(22 + 8 * (cycle - 1) + self.rng.gauss(0, 1), 1),
+            "pressure": round(1013 + self.rng.gauss(0, 5), 1),
+            "co2": round(420 + self.rng.gauss(0, 30), 1) if self.co2 else None,
+            "longitude": self.longitude,
+            "latitude": self.latitude,
+            "recorded": recorded.isoformat(),
+        }
+
+
+def fleet(sensors, start, end, cadence, seed=0):
+    # Measurements from every sensor in recorded order, every cadence seconds
+    rng = random.Random(seed)
+    fleet_ = [Sensor(index, rng) for index in range(sensors)]
+    offsets = [rng.uniform(0, cadence) for _ in fleet_]
+
+    tick = start
+    step = timedelta(seconds=cadence)
+    while tick < end:
+        for sensor, offset in zip(fleet_, offsets):
+            recorded = tick + timedelta(seconds=offset)
+            if recorded < end:
+                yield sensor.measure(recorded)
+        tick += step
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sensors", type=int, default=100)
+    parser.add_argument("--days", type=float, default=1)
+    parser.add_argument("--cadence", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(days=args.days)
+    for measurement in fleet(args.sensors, start, end, args.cadence, args.seed):
+        sys.stdout.write(json.dumps(measurement) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import sys
+import csv
+import json
+import gzip
+import time
+import cbor2
+import msgpack
+import argparse
+import zstandard
+
+from datetime import datetime, timezone, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from fleet import fleet  # noqa: E402
+from app.formats import ENCODINGS, MAX_BODY_SIZE, Body, parser  # noqa: E402
+from app.ingest import validate_measurements  # noqa: E402
+
+
+def layouts(measurements):
+    header = list(measurements[0])
+    return {
+        "rows": measurements,
+        "header": [header] + [[m[h] for h in header] for m in measurements],
+        "columns": {h: [m[h] for m in measurements] for h in header},
+    }
+
+
+def to_csv(rows):
+    text = io.StringIO()
+    csv.writer(text).writerows(rows)
+    return text.getvalue().encode("utf-8")
+
+
+def bodies(measurements):
+    layouts_ = layouts(measurements)
+    yield "json", "rows", "application/json", json.dumps(measurements).encode()
+    for layout, data in layouts_.items():
+        yield "msgpack", layout, "application/msgpack", msgpack.packb(data)
+        yield "cbor", layout, "application/cbor", cbor2.dumps(data)
+    yield "csv", "header", "text/csv", to_csv(layouts_["header"])
+
+
+def decode(body, content_type, encoding):
+    decompressed = Body(MAX_BODY_SIZE)
+    decompressor = ENCODINGS[encoding](decompressed)
+    decompressor.decompress(body)
+    decompressor.flush()
+    return parser(content_type)(bytes(decompressed.data))
+
+
+def measure(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser_ = argparse.ArgumentParser()
+    parser_.add_argument("--sensors", type=int, default=100)
+    parser_.add_argument("--rows", type=int, default=5000)
+    parser_.add_argument("--seed", type=int, default=0)
+    parser_.add_argument("--repeat", type=int, default=10)
+
+    args = parser_.parse_args()
+
+    # Enough days of measurements every 5 minutes to get the rows needed
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(seconds=300 * (args.rows // args.sensors + 1))
+    measurements = list(fleet(args.sensors, start, end, 300, args.seed))
+    measurements = measurements[: args.rows]
+    expected = validate_measurements(json.loads(json.dumps(measurements)), "test")
+
+    compressors = {
+        "identity": bytes,
+        "gzip": gzip.compress,
+        "zstd": zstandard.compress,
+    }
+
+    print(
+        f"{'format':>8} {'layout':>8} {'encoding':>8} {'bytes':>9} "
+        f"{'parse':>12} {'rows/s':>10} {'validated':>12} {'rows/s':>10}"
+    )
+    for name, layout, content_type, body in bodies(measurements):
+        for encoding, compress in compressors.items():
+            compressed = compress(body)
+
+            rows = decode(compressed, content_type, encoding)
+            if validate_measurements(rows, "test") != expected:
+                sys.exit(f"{name} {layout} {encoding} rows differ from the JSON ones")
+
+            parse = measure(
+                lambda: decode(compressed, content_type, encoding), args.repeat
+            )
+            validated = measure(
+                lambda: validate_measurements(
+                    decode(compressed, content_type, encoding), "test"
+                ),
+                args.repeat,
+            )
+
+            print(
+                f"{name:>8} {layout:>8} {encoding:>8} {len(compressed):>9} "
+                f"{parse * 1000:>9.2f} ms {len(rows) / parse:>10.0f} "
+                f"{validated * 1000:>9.2f} ms {len(rows) / validated:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
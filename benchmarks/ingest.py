@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import sqlalchemy
+
+from databases import Database
+from datetime import datetime, timezone, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from app.db import metadata  # noqa: E402
+from app.models import Device, Measurement, measurements, rollups  # noqa: E402
+
+
+def generate(rows):
+    now = datetime.now(timezone.utc)
+
+    return [
+        {
+            "sensor": "bench",
+            "source": f"source-{index % 100}",
+            "description": None,
+            "version": None,
+            "pm1dot0": random.uniform(0, 150),
+            "pm2dot5": random.uniform(0, 150),
+            "pm10": random.uniform(0, 150),
+            "humidity": random.uniform(1, 100),
+            "temperature": random.uniform(-10, 40),
+            "pressure": random.uniform(900, 1050),
+            "co2": random.uniform(300, 2000),
+            "longitude": -57.521369,
+            "latitude": -25.194156,
+            "recorded": now - timedelta(seconds=index),
+            "provider_id": None,
+        }
+        for index in range(rows)
+    ]
+
+
+async def execute_many(db, batch):
+    columns = Measurement.columns()
+    await db.execute_many(
+        measurements.insert(), [{c: m.get(c) for c in columns} for m in batch]
+    )
+
+
+async def bulk(db, batch):
+    # Only the insert store uses, without identifying devices or rollups
+    if db.url.dialect == "postgresql" and db.url.driver in ("", "asyncpg"):
+        await Measurement.copy(db, batch)
+    else:
+        await Measurement.insert_values(db, batch)
+
+
+async def measure(db, method, rows, size):
+    await db.execute(measurements.delete())
+    await db.execute(rollups.delete())
+
+    start = time.perf_counter()
+    for index in range(0, len(rows), size):
+        await method(db, rows[index : index + size])
+    elapsed = time.perf_counter() - start
+
+    return len(rows) / elapsed
+
+
+async def run(url, rows, sizes):
+    methods = {
+        "execute_many": execute_many,
+        "bulk": bulk,
+        "store": Measurement.store,
+    }
+
+    db = Database(url)
+    await db.connect()
+
+    try:
+        # Devices are known already, so the inserts alone are compared
+        await Device.identify(db, rows)
+
+        print(f"{'batch':>8} " + " ".join(f"{m:>14}" for m in methods))
+        for size in sizes:
+            results = [await measure(db, m, rows, size) for m in methods.values()]
+            print(f"{size:>8} " + " ".join(f"{r:>10.0f} r/s" for r in results))
+    finally:
+        await db.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.database_url or f"sqlite:///{directory}/benchmark.db"
+        engine = sqlalchemy.create_engine(url)
+
+        if sqlalchemy.inspect(engine).has_table(measurements.name):
+            parser.error("measurements table already exists, use an empty database")
+
+        metadata.create_all(engine)
+        try:
+            asyncio.run(run(url, generate(args.rows), args.sizes))
+        finally:
+            metadata.drop_all(engine)
+
+
+if __name__ == "__main__":
+    main()
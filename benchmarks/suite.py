@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Martín Abente Lahaye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+import sqlalchemy
+
+from urllib.parse import urlencode
+from datetime import datetime, timezone, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from fleet import LATITUDE, LONGITUDE, fleet  # noqa: E402
+
+MASTER_KEY = "benchmark"
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summary(durations):
+    return {
+        "median_ms": round(statistics.median(durations) * 1000, 3),
+        "p95_ms": round(percentile(durations, 0.95) * 1000, 3),
+    }
+
+
+def queries(end, days):
+    hour = {"start": (end - timedelta(hours=1)).isoformat(), "end": end.isoformat()}
+    day = {"start": (end - timedelta(days=1)).isoformat(), "end": end.isoformat()}
+    whole = {"start": (end - timedelta(days=days)).isoformat(), "end": end.isoformat()}
+    radius = {"latitude": LATITUDE, "longitude": LONGITUDE, "distance": 5}
+
+    return {
+        "retrieve_source": ("/api/v1/measurements", {**day, "source": "fleet-0"}),
+        "retrieve_hour": ("/api/v1/measurements", hour),
+        "retrieve_page": ("/api/v1/measurements", {**day, "limit": 1000}),
+        "radius": ("/api/v1/measurements", {**hour, **radius}),
+        "stats_day": ("/api/v1/stats", day),
+        "stats_whole": ("/api/v1/stats", whole),
+        "stats_radius": ("/api/v1/stats", {**day, **radius}),
+        "aqi": ("/api/v1/aqi", day),
+        "aqi_nowcast": ("/api/v1/aqi", {**day, "method": "nowcast"}),
+        "aqi_nearest": (
+            "/api/v1/aqi/nearest",
+            {"latitude": LATITUDE, "longitude": LONGITUDE},
+        ),
+        "series": (
+            "/api/v1/series",
+            {**whole, "source": "fleet-0", "bucket": "1h", "fields": "pm2dot5"},
+        ),
+    }
+
+
+def ingest(client, key, measurements, batch):
+    headers = {"X-API-Key": key, "Content-Type": "application/json"}
+    durations = []
+    rows = 0
+
+    for index in range(0, len(measurements), batch):
+        body = json.dumps(measurements[index : index + batch])
+        start = time.perf_counter()
+        response = client.post("/api/v1/measurements", content=body, headers=headers)
+        durations.append(time.perf_counter() - start)
+
+        if response.status_code not in (200, 202):
+            sys.exit(f"ingest failed with {response.status_code}: {response.text}")
+        rows += len(measurements[index : index + batch])
+
+    return {
+        "rows": rows,
+        "seconds": round(sum(durations), 3),
+        "rows_per_second": round(rows / sum(durations), 1),
+        **summary(durations),
+    }
+
+
+def measure(client, path, params, repeat):
+    url = f"{path}?{urlencode(params)}"
+    durations = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        durations.append(time.perf_counter() - start)
+
+        if response.status_code != 200:
+            sys.exit(f"{url} failed with {response.status_code}: {response.text}")
+
+    return {"rows": len(response.json()), **summary(durations)}
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(url, args):
+    from fastapi.testclient import TestClient
+    from app import service
+
+    end = datetime.now(timezone.utc).replace(microsecond=0)
+    results = {
+        "commit": commit(),
+        "date": end.isoformat(),
+        "database": sqlalchemy.engine.make_url(url).get_backend_name(),
+        "sensors": args.sensors,
+        "cadence": args.cadence,
+        "seed": args.seed,
+        "batch": args.batch,
+        "repeat": args.repeat,
+        "sizes": [],
+    }
+
+    with TestClient(service.app) as client:
+        response = client.post(
+            "/api/v1/providers",
+            json={"provider": "benchmark"},
+            headers={"X-API-Key": MASTER_KEY},
+        )
+        key = response.json()["key"]
+
+        # Each size adds the days before the previous one
+        previous = 0
+        for days in sorted(args.days):
+            start = end - timedelta(days=days)
+            until = end - timedelta(days=previous)
+            # Same seed, same sensors
+            measurements = list(
+                fleet(args.sensors, start, until, args.cadence, args.seed)
+            )
+
+            size = {
+                "days": days,
+                "ingest": ingest(client, key, measurements, args.batch),
+            }
+            size["queries"] = {
+                name: measure(client, path, params, args.repeat)
+                for name, (path, params) in queries(end, days).items()
+            }
+            results["sizes"].append(size)
+            previous = days
+
+            print(
+                f"{days:>6g} days {size['ingest']['rows']:>9} rows "
+                f"{size['ingest']['rows_per_second']:>10.0f} r/s",
+                file=sys.stderr,
+            )
+            for name, result in size["queries"].items():
+                print(
+                    f"{'':>6} {name:<18} {result['median_ms']:>9.2f} ms "
+                    f"{result['p95_ms']:>9.2f} ms p95 {result['rows']:>7} rows",
+                    file=sys.stderr,
+                )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--sensors", type=int, default=100)
+    parser.add_argument("--days", type=float, nargs="+", default=[1, 7])
+    parser.add_argument("--cadence", type=float, default=300)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", default=None)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.database_url or f"sqlite:///{directory}/benchmark.db"
+
+        # The service reads its configuration once it's imported, and reports
+        # are not cached so every query reaches the database
+        os.environ["DATABASE_URL"] = url
+        os.environ["LINKA_MASTER_KEY"] = MASTER_KEY
+        os.environ["LINKA_REPORTS_CACHE_SIZE"] = "0"
+
+        from app.db import metadata
+        from app.models import measurements
+
+        engine = sqlalchemy.create_engine(url)
+
+        if sqlalchemy.inspect(engine).has_table(measurements.name):
+            parser.error("measurements table already exists, use an empty database")
+
+        metadata.create_all(engine)
+        try:
+            results = run(url, args)
+        finally:
+            metadata.drop_all(engine)
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+        return
+
+    with open(args.output, "w") as file:
+        file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env bash
 
-pyflakes app tests tools && \
-black --check app tests tools && \
+pyflakes app tests tools benchmarks && \
+black --check app tests tools benchmarks && \
 python3 -m pytest -s -vv tests/service.py
@@ -16,7 +16,9 @@
 import os
 import sys
 import copy
+import json
 import pytest
+import asyncio
 
 from urllib.parse import urlencode
 from alembic import config
@@ -85,7 +87,7 @@ aqi = [
         "description": "aqi",
         "longitude": -57.521369,
         "latitude": -25.194156,
-        "quality": {"category": "Moderate", "index": 81},
+        "quality": {"category": "Moderate", "index": 81, "pollutant": "pm2dot5"},
     },
     {
         "source": "nullable",
@@ -101,7 +103,7 @@ aqi = [
         "description": None,
         "longitude": -57.521369,
         "latitude": -25.194156,
-        "quality": {"category": "Good", "index": 0},
+        "quality": {"category": "Good", "index": 0, "pollutant": "pm2dot5"},
     },
 ]
 stats = [
@@ -148,6 +150,13 @@ stats = [
         "temperature": {"average": -89.2, "maximum": -89.2, "minimum": -89.2},
     },
 ]
+series = [
+    {
+        "recorded": "2020-10-24T00:00:00+00:00",
+        "pm2dot5": {"average": 26.4, "maximum": 26.4, "minimum": 26.4},
+        "pm10": {"average": 26.4, "maximum": 26.4, "minimum": 26.4},
+    },
+]
 status = {
     "service": "UP",
     "database": "UP",
@@ -211,6 +220,58 @@ def test_invalid_api_key_access(client):
     assert response.status_code == 403
 
 
+def test_revoked_api_key_access(client):
+    response = client.post(
+        "/api/v1/providers", json={"provider": "revoked"}, headers=master_headers
+    )
+    assert response.status_code == 200
+    revoked_headers = {"X-API-Key": response.json().get("key")}
+
+    response = client.post("/api/v1/measurements", json=[], headers=revoked_headers)
+    assert response.status_code == 200
+
+    response = client.delete("/api/v1/providers/revoked", headers=master_headers)
+    assert response.status_code == 200
+
+    response = client.post("/api/v1/measurements", json=[], headers=revoked_headers)
+    assert response.status_code == 403
+
+
+def test_revoked_during_lookup(monkeypatch):
+    import hashlib
+    from app import authentication, models
+    from app.cache import MISSING
+
+    async def revoked_meanwhile(db, key):
+        models.keys_cache.invalidate()
+        return "revoked"
+
+    monkeypatch.setattr(models.Provider, "get_provider_for_key", revoked_meanwhile)
+
+    key = hashlib.sha256(b"in-flight").hexdigest()
+    assert asyncio.run(authentication.validate_api_key("in-flight")) == "revoked"
+    assert models.keys_cache.get(key) is MISSING
+
+
+@pytest.mark.dependency(depends=["test_record"])
+def test_devices(client):
+    from databases import Database
+    from app.models import Device, devices_cache
+
+    async def identify():
+        rows = [copy.deepcopy(m) for m in measurements]
+        async with Database(os.environ["DATABASE_URL"]) as db:
+            await Device.identify(db, rows)
+        return [r["device_id"] for r in rows]
+
+    cached = asyncio.run(identify())
+    devices_cache.invalidate()
+    found = asyncio.run(identify())
+
+    assert found == cached
+    assert len(set(found)) == len(measurements)
+
+
 @pytest.mark.dependency(depends=["test_record"])
 def test_query(client):
     query = {
@@ -222,6 +283,45 @@ def test_query(client):
     assert response.json() == measurements
 
 
+@pytest.mark.dependency(depends=["test_record"])
+def test_ndjson_query(client):
+    query = {
+        "start": "1984-04-24T00:00:00",
+    }
+
+    response = client.get(
+        f"/api/v1/measurements?{urlencode(query)}",
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    # Rows with equal descriptions may come in any order
+    lines = [json.loads(line) for line in response.iter_lines()]
+    assert sorted(lines, key=json.dumps) == sorted(measurements, key=json.dumps)
+
+
+@pytest.mark.dependency(depends=["test_record"])
+def test_paginated_query(client):
+    query = {
+        "start": "1984-04-24T00:00:00",
+        "limit": 2,
+    }
+
+    response = client.get(f"/api/v1/measurements?{urlencode(query)}")
+    assert response.status_code == 200
+    assert response.json() == measurements[:2]
+
+    query["cursor"] = response.headers["X-Next-Cursor"]
+    response = client.get(f"/api/v1/measurements?{urlencode(query)}")
+    assert response.status_code == 200
+    assert response.json() == measurements[2:]
+    assert "X-Next-Cursor" not in response.headers
+
+    query["cursor"] = "invalid"
+    response = client.get(f"/api/v1/measurements?{urlencode(query)}")
+    assert response.status_code == 422
+
+
 @pytest.mark.dependency(depends=["test_record"])
 def test_empty_query(client):
     query = {
@@ -249,6 +349,58 @@ def test_distance_query(client):
     assert response.json() == measurements
 
 
+def test_distance_within():
+    from types import SimpleNamespace
+    from app.functions import bounds, geohash, geohash_cells
+    from app.models import Measurement
+    from app.schemas import QueryParams
+
+    near = SimpleNamespace(latitude=0.05, longitude=0.0)
+    corner = SimpleNamespace(latitude=0.085, longitude=0.085)
+
+    cells = geohash_cells(*bounds(0.0, 0.0, 10.0))
+    for record in [near, corner]:
+        assert any(
+            geohash(record.latitude, record.longitude).startswith(c) for c in cells
+        )
+
+    query = QueryParams(start=None, latitude=0.0, longitude=0.0, distance=10.0)
+    assert Measurement.within([near, corner], query) == [near]
+
+
+def test_distance_bounds():
+    import numpy as np
+    from app.functions import EARTH_RADIUS, bounds, haversine
+
+    # Points on the circle, east and west of the target they reach past the
+    # longitudes due east and west of it
+    latitude, longitude, kilometers = 60.0, 10.0, 500.0
+    angle = kilometers / EARTH_RADIUS
+    bearings = np.radians(np.arange(0, 360, 0.1))
+    phi, lam = np.radians(latitude), np.radians(longitude)
+    latitudes = np.arcsin(
+        np.sin(phi) * np.cos(angle) + np.cos(phi) * np.sin(angle) * np.cos(bearings)
+    )
+    longitudes = lam + np.arctan2(
+        np.sin(bearings) * np.sin(angle) * np.cos(phi),
+        np.cos(angle) - np.sin(phi) * np.sin(latitudes),
+    )
+    latitudes, longitudes = np.degrees(latitudes), np.degrees(longitudes)
+    assert haversine(latitude, longitude, latitudes, longitudes) == pytest.approx(
+        kilometers
+    )
+
+    north, east, south, west = bounds(latitude, longitude, kilometers)
+    epsilon = 1e-9
+    assert np.all((latitudes <= north + epsilon) & (latitudes >= south - epsilon))
+    assert np.all((longitudes <= east + epsilon) & (longitudes >= west - epsilon))
+    assert east - longitude == pytest.approx(longitudes.max() - longitude)
+
+    # Around the poles every longitude is in
+    assert bounds(89.0, 0.0, 500.0) == (90.0, 180.0, pytest.approx(84.5, 0.01), -180.0)
+    assert bounds(0.0, 179.0, 500.0)[1] == 180.0
+
+
 def test_enforce_utc():
     original = measurements[0]
 
@@ -273,6 +425,140 @@ def test_enforce_utc():
     assert original == past
 
 
+@pytest.mark.dependency(depends=["test_create_provider"])
+def test_ingest_buffer_too_small(client, monkeypatch):
+    from app import service
+
+    monkeypatch.setattr(service.buffer, "size", 1)
+    response = client.post("/api/v1/measurements", json=measurements, headers=headers)
+    assert response.status_code == 413
+    assert "LINKA_INGEST_BUFFER_SIZE" in response.json()["detail"]
+    assert "Retry-After" not in response.headers
+
+
+def test_ingest_buffer():
+    from app.ingest import Buffer
+
+    batches = []
+
+    async def store(rows):
+        batches.append(rows)
+
+    async def run():
+        buffer = Buffer(store, size=3, batch=2, interval=0.01)
+        await buffer.start()
+        assert buffer.put([1, 2, 3])
+        assert not buffer.put([4])
+        await buffer.stop()
+
+    asyncio.run(run())
+    assert batches == [[1, 2], [3]]
+
+    failures = [ConnectionError(), ConnectionError()]
+
+    async def flaky(rows):
+        if failures:
+            raise failures.pop()
+        batches.append(rows)
+
+    async def broken(rows):
+        raise ConnectionError()
+
+    async def retry(store, retries):
+        buffer = Buffer(store, 3, 3, 0.01, retries=retries, backoff=0)
+        await buffer.start()
+        assert buffer.put([4, 5, 6])
+        await buffer.stop()
+        return buffer
+
+    assert asyncio.run(retry(flaky, 2)).dropped == 0
+    assert batches[-1] == [4, 5, 6]
+    assert asyncio.run(retry(broken, 2)).dropped == 3
+
+
+def test_periodic():
+    from app.periodic import Periodic
+
+    runs = []
+
+    async def count():
+        runs.append(len(runs))
+        if len(runs) == 1:
+            raise RuntimeError
+
+    async def run():
+        periodic = Periodic(count, interval=0.01)
+        await periodic.start()
+        await asyncio.sleep(0.05)
+        await periodic.stop()
+
+    asyncio.run(run())
+    assert len(runs) > 1
+
+
+def test_reports_cache():
+    from datetime import datetime, timezone
+    from app import reports
+    from app.schemas import QueryParams
+
+    calls = []
+
+    @reports.cached("test")
+    async def generate(db, query):
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        return [query.source]
+
+    start = datetime(2020, 10, 24, 0, 0, 30, tzinfo=timezone.utc)
+    query = QueryParams(source="test", start=start)
+    row = {"source": "test", "recorded": start}
+
+    async def run():
+        results = await asyncio.gather(*[generate(None, query) for _ in range(3)])
+        assert results == [["test"]] * 3
+        assert await generate(None, query) == ["test"]
+        reports.invalidate([row])
+        assert await generate(None, query) == ["test"]
+
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert calls[0].start == datetime(2020, 10, 24, tzinfo=timezone.utc)
+
+
+def test_recent():
+    from datetime import datetime, timedelta, timezone
+    from app.models import IDENTITY, STATS
+    from app.recent import Recent
+    from app.schemas import QueryParams
+
+    now = datetime.now(timezone.utc)
+    rows = [{**m, "recorded": now} for m in measurements]
+    old = {**measurements[0], "recorded": now - timedelta(minutes=10)}
+
+    recent = Recent(span=300, stats=STATS, identity=IDENTITY)
+    recent.warm([old])
+    recent.add(list(reversed(rows)))
+
+    query = QueryParams(start=None)
+    assert recent.covers(query)
+    assert not recent.covers(QueryParams(start=now - timedelta(minutes=10)))
+    assert not recent.covers(QueryParams(start=None, limit=1))
+
+    records = recent.select(query)
+    assert [r.sensor for r in records] == ["aqi", "nullable", "test"]
+    assert recent.select(QueryParams(start=now, source="test"))[0].sensor == "test"
+    assert recent.select(QueryParams(start=now, distance=1.0)) == []
+
+    results = recent.stats(query)
+    assert results[0].pm2dot5_average == 26.4
+    assert results[1].pm2dot5_maximum is None
+
+    # The same device, whether its description is missing or empty
+    test = rows[-1]
+    recent.add([{**test, "description": None}, {**test, "description": ""}])
+    assert len(recent.stats(QueryParams(start=now, source="test"))) == 1
+
+
 @pytest.mark.dependency(depends=["test_record"])
 def test_aqi(client):
     query = {
@@ -284,6 +570,145 @@ def test_aqi(client):
     assert response.json() == aqi
 
 
+def test_aqi_brackets():
+    from app.reports import AQI
+
+    indexes, categories = AQI.get_indexes([0.0, 12.0, 12.05, 500.4, 1000.0])
+    assert indexes.tolist()[:2] == pytest.approx([0.0, 50.0])
+    assert categories.tolist() == [0, 0, 1, 6, 6]
+
+
+@pytest.mark.dependency(depends=["test_record"])
+def test_aqi_nowcast(client):
+    query = {"method": "nowcast", "end": "2020-10-24T21:00:00"}
+
+    response = client.get(f"/api/v1/aqi?{urlencode(query)}")
+    assert response.status_code == 200
+    # A single hour isn't enough for NowCast
+    assert sorted(r["source"] for r in response.json()) == ["aqi", "nullable", "test"]
+    assert all(r["quality"] is None for r in response.json())
+
+
+@pytest.mark.dependency(depends=["test_record"])
+def test_aqi_nearest(client):
+    query = {"latitude": -25.194156, "longitude": -57.521369, "n": 2}
+
+    response = client.get(f"/api/v1/aqi/nearest?{urlencode(query)}")
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+    # Nothing was measured in the last minutes
+    assert all(r["quality"] is None for r in response.json())
+
+    response = client.get("/api/v1/aqi/nearest?latitude=0")
+    assert response.status_code == 422
+
+    from databases import Database
+    from app.models import Measurement, locations
+
+    async def relocate():
+        async with Database(os.environ["DATABASE_URL"]) as db:
+            await Measurement.relocate(db)
+
+    # As if another worker had stored them
+    known = len(locations)
+    locations.clear()
+    asyncio.run(relocate())
+    assert len(locations) == known > 0
+
+    version = locations.version
+    asyncio.run(relocate())
+    assert locations.version == version
+
+
+def test_nearest_locations():
+    import random
+    from app.functions import haversine
+    from app.nearest import Locations
+
+    rows = [
+        {
+            "source": str(i),
+            "latitude": random.uniform(-60, 60),
+            "longitude": random.uniform(-180, 180),
+        }
+        for i in range(600)
+    ]
+
+    locations = Locations(identity=["source", "latitude", "longitude"])
+    for index in range(0, len(rows), 50):
+        locations.add(rows[index : index + 50])
+    locations.add(rows[:10])
+    assert len(locations) == len(rows)
+
+    nearest = locations.nearest(0.0, 0.0, 5)
+    distances = haversine(
+        0.0, 0.0, [r["latitude"] for r in rows], [r["longitude"] for r in rows]
+    )
+    expected = sorted(zip(distances.tolist(), [r["source"] for r in rows]))[:5]
+    assert [s["source"] for s, _ in nearest] == [s for _, s in expected]
+    assert [k for _, k in nearest] == pytest.approx([d for d, _ in expected])
+
+
+def test_rollup_spans():
+    from datetime import datetime, timedelta, timezone
+    from app.models import Rollup
+
+    start = datetime(2026, 11, 18, 10, 0, tzinfo=timezone.utc)
+    minutes = [start + timedelta(minutes=m, seconds=30) for m in (0, 1, 5)]
+    touched = {1: set(minutes), 2: {minutes[0]}, 3: {minutes[-1]}}
+
+    def at(minute):
+        return start + timedelta(minutes=minute)
+
+    assert Rollup.spans(touched, 60) == {
+        (at(0), at(2)): [1],
+        (at(5), at(6)): [1, 3],
+        (at(0), at(1)): [2],
+    }
+    assert Rollup.spans(touched, 3600) == {(at(0), at(60)): [1, 2, 3]}
+
+
+def test_partition_months():
+    from datetime import datetime, timezone
+    from app.partitions import literal, month, months, name
+
+    start = datetime(2026, 11, 18, 10, 30, tzinfo=timezone.utc)
+    ranges = months(start, month(start, 3))
+
+    assert [name(f) for f, _ in ranges] == [
+        "measurements_2026_11",
+        "measurements_2026_12",
+        "measurements_2027_01",
+    ]
+    assert all(first < last == month(first, 1) for first, last in ranges)
+    assert literal(ranges[-1][1]) == "'2027-02-01 00:00:00+00'"
+    assert months(start, month(start)) == []
+
+
+def test_aqi_pollutants():
+    import numpy as np
+    from app.reports import AQI
+    from app.schemas import Category, Pollutant
+
+    nan = np.nan
+    hours = np.array([[10.0, 20.0] + [nan] * 10, [10.0] + [nan] * 11, [0.0] * 12])
+    nowcast = AQI.get_nowcast(hours)
+    assert nowcast[0] == pytest.approx(13.3333, abs=1e-4)
+    assert np.isnan(nowcast[1])
+    assert nowcast[2] == 0.0
+
+    qualities = AQI.get_qualities(
+        {
+            Pollutant.PM2DOT5: np.array([26.4, 10.0, nan]),
+            Pollutant.PM10: np.array([26.4, 200.0, nan]),
+        }
+    )
+    assert qualities[0].pollutant == Pollutant.PM2DOT5
+    assert qualities[1].pollutant == Pollutant.PM10
+    assert qualities[1].category == Category.UNHEALTHY_FOR_SENSITIVE_GROUPS
+    assert qualities[2] is None
+
+
 @pytest.mark.dependency(depends=["test_record"])
 def test_stats(client):
     query = {"start": "1984-04-24T00:00:00"}
@@ -293,12 +718,484 @@ def test_stats(client):
     assert response.json() == stats
 
 
+@pytest.mark.dependency(depends=["test_record"])
+def test_series(client):
+    query = {
+        "source": "aqi",
+        "start": "2020-10-23T12:00:00",
+        "end": "2020-10-25T12:00:00",
+        "bucket": "1d",
+        "fields": "pm2dot5,pm10",
+    }
+
+    response = client.get(f"/api/v1/series?{urlencode(query)}")
+    assert response.status_code == 200
+    assert response.json() == series
+
+    query["fields"] = "pm2dot5,pm10,pm2dot5"
+    response = client.get(f"/api/v1/series?{urlencode(query)}")
+    assert response.status_code == 200
+    assert response.json() == series
+
+    query["fields"] = "invalid"
+    response = client.get(f"/api/v1/series?{urlencode(query)}")
+    assert response.status_code == 422
+
+
+@pytest.mark.dependency(depends=["test_record"])
+def test_retention(client, monkeypatch):
+    from app import models, reports
+    from app.db import db
+
+    monkeypatch.setattr(models, "RETENTION_DAYS", 365)
+    reports.reports_cache.invalidate()
+
+    assert client.portal.call(models.Retention.compact, db, 2) == 3
+    assert client.portal.call(models.Retention.compact, db, 2) == 0
+
+    query = {"start": "1984-04-24T00:00:00"}
+    response = client.get(f"/api/v1/measurements?{urlencode(query)}")
+    assert response.json() == []
+
+    response = client.get(f"/api/v1/stats?{urlencode(query)}")
+    key = lambda s: s["source"]  # noqa: E731
+    assert sorted(response.json(), key=key) == sorted(stats, key=key)
+
+    late = {**measurements[0], "pm2dot5": 10.0}
+    response = client.post("/api/v1/measurements", json=[late], headers=headers)
+    assert response.status_code == 200
+
+    response = client.get(f"/api/v1/stats?{urlencode({**query, 'source': 'aqi'})}")
+    assert response.json()[0]["pm2dot5"] == {
+        "average": pytest.approx(18.2),
+        "maximum": 26.4,
+        "minimum": 10.0,
+    }
+
+
 def test_status(client):
     response = client.get("/api/v1/status")
     assert response.status_code == 200
     assert response.json() == status
 
 
+@pytest.mark.dependency(depends=["test_record"])
+def test_metrics(client):
+    client.get("/api/v1/status")
+
+    response = client.get("/metrics")
+    assert response.status_code == 403
+
+    response = client.get("/metrics", headers=master_headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    lines = response.text.splitlines()
+    requests = 'method="GET",path="/api/v1/status",status="200",le="+Inf"'
+    assert f"linka_request_duration_seconds_bucket{{{requests}}} 2.0" in lines
+    assert any(line.startswith("linka_ingested_measurements_total ") for line in lines)
+    assert any('_count{query="store"}' in line for line in lines)
+    assert any(
+        line.startswith('linka_cache_hits_total{cache="auth"}') for line in lines
+    )
+
+
+def test_histogram():
+    from app.metrics import Histogram
+
+    histogram = Histogram("test_seconds", "Test", buckets=[0.1, 1.0])
+    for value in [0.05, 0.1, 0.5, 5.0]:
+        histogram.observe(value, path="/")
+
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{path="/",le="0.1"} 2.0',
+        'test_seconds_bucket{path="/",le="1.0"} 3.0',
+        'test_seconds_bucket{path="/",le="+Inf"} 4.0',
+        'test_seconds_sum{path="/"} 5.65',
+        'test_seconds_count{path="/"} 4.0',
+    ]
+
+
+def test_profiler(tmp_path):
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+    from app.profiling import Profiler
+
+    async def hello(request):
+        return PlainTextResponse("hello", status_code=201)
+
+    inner = Starlette(routes=[Route("/", hello)])
+    profile = {"X-Profile": MASTER_KEY}
+
+    with TestClient(Profiler(inner, enabled=True, directory=None)) as _client:
+        assert _client.get("/").text == "hello"
+        assert _client.get("/", headers={"X-Profile": "wrong"}).text == "hello"
+
+        response = _client.get("/", headers=profile)
+        assert response.status_code == 200
+        assert response.headers["X-Profile-Status"] == "201"
+        assert "function calls" in response.text
+
+    with TestClient(Profiler(inner, enabled=True, directory=tmp_path)) as _client:
+        response = _client.get("/", headers=profile)
+        assert response.text == "hello"
+        assert (tmp_path / response.headers["X-Profile"]).exists()
+
+    with TestClient(Profiler(inner, enabled=False, directory=None)) as _client:
+        assert _client.get("/", headers=profile).text == "hello"
+
+
+def test_slow_log(caplog):
+    import sqlalchemy
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+    from sqlalchemy.dialects import sqlite
+    from app.models import measurements
+    from app.profiling import SlowLog, traced
+
+    async def query(request):
+        select = sqlalchemy.select([measurements.c.id])
+        select = select.where(measurements.c.pm2dot5 > 12.5)
+        with traced(select):
+            await asyncio.sleep(0.01)
+        return PlainTextResponse("done")
+
+    inner = Starlette(routes=[Route("/", query)])
+    dialect = sqlite.dialect()
+
+    with TestClient(SlowLog(inner, 1.0, 1.0, dialect)) as _client:
+        _client.get("/")
+    assert not caplog.records
+
+    with TestClient(SlowLog(inner, 0.001, 1.0, dialect)) as _client:
+        _client.get("/?source=slow")
+
+    message = caplog.records[-1].getMessage()
+    assert "GET /?source=slow" in message
+    assert "FROM measurements" in message
+    assert "12.5" in message
+
+
+def test_compression():
+    import zlib
+    import brotli
+    import zstandard
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse, StreamingResponse
+    from starlette.routing import Route
+    from app.compression import Compress, negotiate
+
+    text = "linka " * 1000
+    decompress = {
+        "gzip": lambda b: zlib.decompress(b, 16 + zlib.MAX_WBITS),
+        "zstd": lambda b: zstandard.ZstdDecompressor().decompressobj().decompress(b),
+        "br": brotli.decompress,
+    }
+
+    async def small(request):
+        return PlainTextResponse("linka")
+
+    async def large(request):
+        return PlainTextResponse(text, headers={"ETag": '"linka"'})
+
+    async def streamed(request):
+        async def chunks():
+            for _ in range(10):
+                yield "linka " * 100
+
+        return StreamingResponse(chunks(), media_type="text/plain")
+
+    inner = Starlette(
+        routes=[
+            Route("/small", small),
+            Route("/large", large),
+            Route("/streamed", streamed),
+        ]
+    )
+    compress = Compress(
+        inner, ["zstd", "br", "gzip"], 500, {"zstd": 3, "br": 4, "gzip": 6}
+    )
+
+    def get(client, url, accept):
+        with client.stream("GET", url, headers={"Accept-Encoding": accept}) as r:
+            return r, b"".join(r.iter_raw())
+
+    with TestClient(compress) as _client:
+        response, body = get(_client, "/small", "gzip")
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert body == b"linka"
+
+        response, body = get(_client, "/large", "identity")
+        assert "Content-Encoding" not in response.headers
+        assert body.decode() == text
+
+        for encoding in decompress:
+            for url in ["/large", "/streamed"]:
+                response, body = get(_client, url, f"{encoding}, deflate")
+                assert response.headers["Content-Encoding"] == encoding
+                assert len(body) < len(text)
+                assert decompress[encoding](body).decode() == text
+
+            response, _ = get(_client, "/large", encoding)
+            assert response.headers["Content-Length"] != str(len(text))
+            assert response.headers["ETag"] == 'W/"linka"'
+
+    assert negotiate("gzip, br, zstd", ["zstd", "br", "gzip"]) == "zstd"
+    assert negotiate("gzip;q=1.0, zstd;q=0.5", ["zstd", "br", "gzip"]) == "gzip"
+    assert negotiate("*;q=0.1, zstd;q=0", ["zstd", "br", "gzip"]) == "br"
+    assert negotiate("identity, deflate", ["zstd", "br", "gzip"]) is None
+    assert negotiate("", ["zstd", "br", "gzip"]) is None
+
+
+def test_validate_measurements():
+    from typing import List
+    from pydantic import BaseConfig, ValidationError
+    from pydantic.fields import ModelField
+    from fastapi.exceptions import RequestValidationError
+    from app.ingest import validate_measurements
+    from app.schemas import Measurement
+
+    field = ModelField.infer(
+        name="measurements",
+        value=...,
+        annotation=List[Measurement],
+        class_validators={},
+        config=BaseConfig,
+    )
+
+    def expected(body):
+        values, errors = field.validate(body, {}, loc=("body",))
+        if errors:
+            return ValidationError([errors], Measurement).errors()
+        return [v.to_orm("test") for v in values]
+
+    def actual(body):
+        try:
+            return validate_measurements(body, "test")
+        except RequestValidationError as error:
+            return error.errors()
+
+    valid = [
+        measurements[0],
+        {**measurements[0], "recorded": "2020-10-24T17:47:57.370-03:00"},
+        {**measurements[0], "recorded": "2020-10-24 20:47:57Z", "pm10": 10},
+        {**measurements[1], "recorded": "2020-10-24T20:47"},
+        {**measurements[1], "pm2dot5": "12.5", "recorded": 1603572477},
+    ]
+    assert actual(copy.deepcopy(valid)) == expected(copy.deepcopy(valid))
+
+    invalid = valid + [
+        None,
+        5,
+        {**measurements[0], "pm2dot5": 500.1, "humidity": 0},
+        {**measurements[0], "co2": True, "sensor": None},
+        {**measurements[0], "recorded": "2020-10-24"},
+        {"source": "missing"},
+    ]
+    assert actual(copy.deepcopy(invalid)) == expected(copy.deepcopy(invalid))
+    assert actual({}) == [
+        {
+            "loc": ("body",),
+            "msg": "value is not a valid list",
+            "type": "type_error.list",
+        }
+    ]
+
+
+def test_measurement_formats():
+    import io
+    import csv
+    import cbor2
+    import msgpack
+    from app.formats import parser
+    from app.ingest import validate_measurements
+
+    rows = copy.deepcopy(measurements)
+    header = list(rows[0])
+    layouts = [
+        rows,
+        [header] + [[r[h] for h in header] for r in rows],
+        {h: [r[h] for r in rows] for h in header},
+    ]
+
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerows(layouts[1])
+
+    bodies = [("text/csv", text.getvalue().encode("utf-8"))]
+    for layout in layouts:
+        bodies.append(("application/msgpack", msgpack.packb(layout)))
+        bodies.append(("application/cbor", cbor2.dumps(layout)))
+
+    expected = validate_measurements(rows, "test")
+    for content_type, body in bodies:
+        decoded = parser(content_type)(body)
+        assert validate_measurements(decoded, "test") == expected
+
+
+@pytest.mark.dependency(depends=["test_create_provider"])
+def test_post_formats(client, monkeypatch):
+    import gzip
+    import cbor2
+    import msgpack
+    import zstandard
+
+    invalid = [{**measurements[0], "pm2dot5": 600}]
+    bodies = {
+        "application/msgpack": msgpack.packb(invalid),
+        "application/cbor": cbor2.dumps(invalid),
+        "text/csv": f"pm2dot5,source\n600,{invalid[0]['source']}\n".encode("utf-8"),
+    }
+    encodings = {
+        "identity": bytes,
+        "gzip": gzip.compress,
+        "zstd": zstandard.compress,
+    }
+
+    for content_type, body in bodies.items():
+        for encoding, compress in encodings.items():
+            response = client.post(
+                "/api/v1/measurements",
+                content=compress(body),
+                headers={
+                    **headers,
+                    "Content-Type": content_type,
+                    "Content-Encoding": encoding,
+                },
+            )
+            assert response.status_code == 422
+            locations = [e["loc"] for e in response.json()["detail"]]
+            assert ["body", 0, "pm2dot5"] in locations
+
+    response = client.post(
+        "/api/v1/measurements",
+        content=b"[]",
+        headers={**headers, "Content-Type": "text/plain"},
+    )
+    assert response.status_code == 415
+
+    response = client.post(
+        "/api/v1/measurements",
+        content=b"[]",
+        headers={
+            **headers,
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        },
+    )
+    assert response.status_code == 400
+
+    # Rejected before the whole body is decompressed
+    from fastapi import HTTPException
+    from app import formats
+
+    monkeypatch.setattr(formats, "MAX_BODY_SIZE", 1024)
+    for encoding, compress in encodings.items():
+        response = client.post(
+            "/api/v1/measurements",
+            content=compress(b" " * 16 * formats.CHUNK_SIZE),
+            headers={**headers, "Content-Encoding": encoding},
+        )
+        assert response.status_code == 413
+
+        if encoding == "identity":
+            continue
+
+        body = formats.Body(1024)
+        with pytest.raises(HTTPException):
+            formats.ENCODINGS[encoding](body).decompress(
+                compress(b" " * 16 * formats.CHUNK_SIZE)
+            )
+        assert len(body.data) <= 1024 + formats.CHUNK_SIZE
+
+
+@pytest.mark.dependency(depends=["test_record"])
+def test_orjson(client, monkeypatch):
+    from app import responses
+
+    query = urlencode({"start": "1984-04-24T00:00:00"})
+    urls = [
+        f"/api/v1/measurements?{query}",
+        f"/api/v1/measurements?{query}&limit=2",
+        f"/api/v1/aqi?{query}",
+        f"/api/v1/aqi?{query}&method=nowcast",
+        "/api/v1/aqi/nearest?latitude=-25.194156&longitude=-57.521369",
+        f"/api/v1/stats?{query}",
+    ]
+    expected = [client.get(url).json() for url in urls]
+
+    monkeypatch.setattr(responses, "ORJSON", True)
+    for url, body in zip(urls, expected):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/json"
+        assert response.json() == body
+
+
+@pytest.mark.dependency(depends=["test_record"])
+def test_conditional(client, monkeypatch):
+    from app import conditional, models
+
+    query = urlencode({"start": "1984-04-24T00:00:00"})
+    urls = [
+        f"/api/v1/measurements?{query}",
+        f"/api/v1/aqi?{query}",
+        f"/api/v1/aqi?{query}&method=nowcast&end=2020-10-24T21:00:00",
+        f"/api/v1/stats?{query}",
+    ]
+    responses = [client.get(url) for url in urls]
+    for response in responses:
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "no-cache"
+    assert len({r.headers["ETag"] for r in responses}) == len(urls)
+
+    async def unexpected(db, query):
+        raise AssertionError("stats were generated")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(models.Measurement, "stats", unexpected)
+        patch.setattr(models.Measurement, "hourly", unexpected)
+
+        for url, response in zip(urls, responses):
+            etag = response.headers["ETag"]
+            for validators in [
+                {"If-None-Match": etag},
+                {"If-None-Match": f'"other", W/{etag.lstrip("W/")}'},
+                {"If-Modified-Since": response.headers["Last-Modified"]},
+            ]:
+                unchanged = client.get(url, headers=validators)
+                assert unchanged.status_code == 304
+                assert unchanged.content == b""
+                assert unchanged.headers["ETag"].lstrip("W/") == etag.lstrip("W/")
+
+    changed = {
+        "If-None-Match": '"other"',
+        "If-Modified-Since": "Tue, 24 Apr 1984 00:00:00 GMT",
+    }
+    for url, response in zip(urls, responses):
+        assert client.get(url, headers=changed).json() == response.json()
+
+    # Polling the default window, which moves on with every request
+    monkeypatch.setattr(conditional, "DEFAULT_WINDOW_STEP", 3600)
+    for url in ["/api/v1/measurements", "/api/v1/aqi", "/api/v1/stats"]:
+        etag = client.get(url).headers["ETag"]
+        unchanged = client.get(url, headers={"If-None-Match": etag})
+        assert unchanged.status_code == 304
+
+    # Any measurement stored for the query changes its validators
+    response = client.post(
+        "/api/v1/measurements", json=measurements[:1], headers=headers
+    )
+    assert response.status_code == 200
+
+    for url, response in zip(urls, responses):
+        etag = response.headers["ETag"]
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+
 @pytest.mark.dependency(
     depends=[
         "test_query",
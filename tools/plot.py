@@ -25,7 +25,7 @@ from urllib.parse import urlencode
 from datetime import datetime, timezone, timedelta
 
 
-def fetch(endpoint, source, days):
+def fetch(endpoint, source, days, bucket):
     now = datetime.now(timezone.utc)
     days_ago = now - timedelta(days=days)
 
@@ -33,6 +33,8 @@ def fetch(endpoint, source, days):
         "source": source,
         "start": days_ago.isoformat(),
         "end": now.isoformat(),
+        "bucket": bucket,
+        "fields": "pm2dot5",
     }
 
     url = f"{endpoint}?{urlencode(query)}"
@@ -46,7 +48,7 @@ def plot(data, output, visualize):
         "date": [],
     }
     for entry in data:
-        frame["PM2.5"].append(entry["pm2dot5"])
+        frame["PM2.5"].append(entry["pm2dot5"]["average"])
         frame["date"].append(dateutil.parser.parse(entry["recorded"]))
 
     df = pd.DataFrame(frame)
@@ -62,11 +64,14 @@ def main():
     parser.add_argument("--endpoint", required=True)
     parser.add_argument("--source", required=True)
     parser.add_argument("--days", type=int, required=True)
+    parser.add_argument(
+        "--bucket", default="1h", choices=["1m", "5m", "15m", "1h", "1d"]
+    )
     parser.add_argument("--output", required=True)
     parser.add_argument("--visualize", action="store_true", default=False)
 
     args = parser.parse_args()
-    data = fetch(args.endpoint, args.source, args.days)
+    data = fetch(args.endpoint, args.source, args.days, args.bucket)
     plot(data, args.output, args.visualize)
 
 